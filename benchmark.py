@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+
+BENCH_CARS = (50, 200, 1000)
+BENCH_RANKS = (5, 10, 20)
+BENCH_STEPS = 20
+BENCH_SAVE_STEPS = 5
+BENCH_RENDER_STEPS = 2
+BENCH_SEED = 0
+
+def _timed(fn, repeat: int = 1):
+    # Mean seconds per call
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        fn()
+
+    return (time.perf_counter() - start) / repeat
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_one(num_cars: int, topology_rank: int, steps: int = BENCH_STEPS, save_steps: int = BENCH_SAVE_STEPS, render_steps: int = BENCH_RENDER_STEPS):
+    # Runs in a fresh process, so peak RSS belongs to this configuration only
+    from topology import SquareGridRoadTopology
+    from simulation import City, SEGMENT_LENS
+
+    result = {"num_cars": num_cars, "topology_rank": topology_rank, "steps": steps, "base_rss_kb": _peak_rss_kb()}
+
+    result["topology_build_s"] = _timed(lambda: SquareGridRoadTopology(topology_rank, random_weights=False, constant_weight=SEGMENT_LENS))
+    result["city_build_s"] = _timed(lambda: City(num_cars, topology_rank, headless=True, seed=BENCH_SEED))
+
+    # The first step fills the k-NN segment cache and is reported on its own
+    city = City(num_cars, topology_rank, headless=True, seed=BENCH_SEED)
+    result["first_step_s"] = _timed(city.simulation_step)
+
+    city.stats.enabled = True
+    step_s = _timed(city.simulation_step, repeat=steps)
+
+    result["step_s"] = step_s
+    result["steps_per_second"] = 1 / step_s if step_s > 0 else float("inf")
+    result.update({f"phase_{name}_s": seconds / steps for name, seconds in city.stats.times.items()})
+    result.update({f"{name}_per_step": n / steps for name, n in city.stats.counters.items()})
+    city.stats.enabled = False
+
+    segments = city.topology.unique_road_segments
+    result["segment_metrics_s"] = _timed(city.segment_metrics)
+    result["segment_metrics_tables_s"] = _timed(lambda: city.segment_metrics(include_tables=True))
+    result["sparse_intervals_s"] = _timed(city.all_segment_sparse_intervals)
+    result["per_segment_metrics_s"] = _timed(lambda: [(city.segment_connectedness(s), city.average_num_vehicles_per_area(s), city.std_area_densities(s)) for s in segments])
+    result["network_topology_s"] = _timed(lambda: city.current_network_topology)
+    result["network_csr_s"] = _timed(city.network_csr)
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+
+    try:
+        if save_steps > 0:
+            city = City(num_cars, topology_rank, headless=True, seed=BENCH_SEED)
+            result["save_trace_s"] = _timed(lambda: city.save_simulation_with_graphics(save_steps, os.path.join(workdir, "out.gif"),
+                data_out_filename=os.path.join(workdir, "trace"), render=False)) / save_steps
+
+        if render_steps > 0:
+            filename = os.path.join(workdir, "out.mp4" if shutil.which("ffmpeg") is not None else "out.gif")
+            city = City(num_cars, topology_rank, headless=True, seed=BENCH_SEED)
+            result["save_render_s"] = _timed(lambda: city.save_simulation_with_graphics(render_steps, filename,
+                data_out_filename=os.path.join(workdir, "render_trace"))) / render_steps
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result["peak_rss_kb"] = _peak_rss_kb()
+
+    return result
+
+def _revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(cars: tuple = BENCH_CARS, ranks: tuple = BENCH_RANKS, steps: int = BENCH_STEPS, save_steps: int = BENCH_SAVE_STEPS, render_steps: int = BENCH_RENDER_STEPS):
+    context = multiprocessing.get_context("spawn")
+    results = list()
+
+    for topology_rank in ranks:
+        for num_cars in cars:
+            with context.Pool(1) as pool:
+                result = pool.apply(bench_one, (num_cars, topology_rank, steps, save_steps, render_steps))
+
+            print(f"cars={num_cars} rank={topology_rank} {result['steps_per_second']:.1f} steps/s peak {result['peak_rss_kb'] / 1024:.0f} MB", file=sys.stderr)
+            results.append(result)
+
+    return {
+        "meta": {
+            "revision": _revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+def compare(old: dict, new: dict):
+    # new / old ratio of every timing, per (num_cars, topology_rank)
+    old_results = {(r["num_cars"], r["topology_rank"]): r for r in old["results"]}
+    ratios = list()
+
+    for r in new["results"]:
+        o = old_results.get((r["num_cars"], r["topology_rank"]))
+
+        if o is None:
+            continue
+
+        ratios.append({"num_cars": r["num_cars"], "topology_rank": r["topology_rank"],
+            **{k: r[k] / o[k] for k in r if k.endswith("_s") and k in o and o[k] > 0}})
+
+    return ratios
+
+if __name__ == "__main__":
+    # python benchmark.py out.json [cars,cars,... ranks,ranks,... steps]
+    # python benchmark.py compare old.json new.json
+    if sys.argv[1] == "compare":
+        with open(sys.argv[2]) as f, open(sys.argv[3]) as g:
+            for ratio in compare(json.load(f), json.load(g)):
+                print(json.dumps(ratio))
+    else:
+        cars = tuple(int(x) for x in sys.argv[2].split(",")) if len(sys.argv) > 2 else BENCH_CARS
+        ranks = tuple(int(x) for x in sys.argv[3].split(",")) if len(sys.argv) > 3 else BENCH_RANKS
+        steps = int(sys.argv[4]) if len(sys.argv) > 4 else BENCH_STEPS
+
+        with open(sys.argv[1], "w") as f:
+            json.dump(run_benchmarks(cars, ranks, steps), f, indent=1)
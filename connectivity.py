@@ -0,0 +1,77 @@
+import numpy as np
+
+def union_find_components(num_nodes: int, src, dst):
+    # Component label of every node (the smallest node index in it) for the
+    # undirected edges (src, dst). Union-find run over all edges at once:
+    # every round hooks the larger root of each edge under the smaller one
+    # and then compresses paths by pointer jumping.
+    parent = np.arange(num_nodes, dtype=np.int64)
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+
+    while True:
+        root_src = parent[src]
+        root_dst = parent[dst]
+        split = root_src != root_dst
+
+        if not split.any():
+            return parent
+
+        np.minimum.at(parent, np.maximum(root_src, root_dst)[split], np.minimum(root_src, root_dst)[split])
+
+        while True:
+            grandparent = parent[parent]
+
+            if np.array_equal(grandparent, parent):
+                break
+
+            parent = grandparent
+
+def multi_source_hops(indptr, indices, sources):
+    # Hops from every node to the nearest source over a CSR graph, -1 for
+    # nodes no source reaches. Breadth first, one frontier at a time.
+    num_nodes = len(indptr) - 1
+    hops = np.full(num_nodes, -1, dtype=np.int64)
+    frontier = np.unique(np.asarray(sources, dtype=np.int64))
+    hops[frontier] = 0
+    level = 0
+
+    while len(frontier) > 0:
+        starts = indptr[frontier]
+        counts = indptr[frontier + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        neighbors = np.unique(indices[offsets])
+        frontier = neighbors[hops[neighbors] < 0]
+        level += 1
+        hops[frontier] = level
+
+    return hops
+
+def contact_connectivity(num_uavs: int, num_cars: int, src, dst):
+    # Connectivity of a contact network over integer node indices, UAVs
+    # first (0 .. num_uavs-1) then cars, from its undirected edge list
+    num_nodes = num_uavs + num_cars
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+
+    labels = union_find_components(num_nodes, src, dst)
+    sizes = np.bincount(labels, minlength=num_nodes)
+
+    rows = np.concatenate([src, dst])
+    cols = np.concatenate([dst, src])
+    order = np.argsort(rows, kind="stable")
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_nodes))
+
+    hops = multi_source_hops(indptr, cols[order], np.arange(num_uavs))
+    car_hops = hops[num_uavs:]
+
+    return {
+        "labels": labels,
+        "num_components": int(np.count_nonzero(sizes)),
+        "largest_component": int(sizes.max(initial=0)),
+        "uav_coverage": float(np.mean(car_hops == 1)) if num_cars > 0 else 0.0,
+        "uav_reachable": float(np.mean(car_hops >= 0)) if num_cars > 0 else 0.0,
+        "car_hops_to_uav": car_hops,
+    }
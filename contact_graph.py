@@ -0,0 +1,143 @@
+import numpy as np
+import networkx as nx
+
+CONTACT_KINDS = ("uav", "uav_car", "car")
+
+class ContactGraph(object):
+    # Persistent V2V/V2I contact graph. Links are kept as sets of integer id
+    # pairs per kind ("uav": UAV-UAV, "uav_car": UAV-car, "car": car-car);
+    # update() takes the current link sets and records what was added and
+    # removed. The networkx view is patched with that diff instead of being
+    # rebuilt, and the same links can be exported as arrays or CSR.
+
+    def __init__(self, uav_ids: list, car_ids: list):
+        self.uav_ids = list(uav_ids)
+        self.car_ids = list(car_ids)
+
+        self.links = {kind: set() for kind in CONTACT_KINDS}
+        self.added = {kind: set() for kind in CONTACT_KINDS}
+        self.removed = {kind: set() for kind in CONTACT_KINDS}
+
+        self._graph = None
+        self._pending_added = {kind: set() for kind in CONTACT_KINDS}
+        self._pending_removed = {kind: set() for kind in CONTACT_KINDS}
+
+    @staticmethod
+    def _labels(kind: str, link: tuple):
+        if kind == "uav":
+            return f"U{link[0]}", f"U{link[1]}"
+
+        if kind == "uav_car":
+            return f"U{link[0]}", f"C{link[1]}"
+
+        return f"C{link[0]}", f"C{link[1]}"
+
+    @property
+    def node_labels(self):
+        return [f"U{uav_id}" for uav_id in self.uav_ids] + [f"C{car_id}" for car_id in self.car_ids]
+
+    def update(self, links: dict):
+        # links: kind -> set of id pairs. UAV-UAV and car-car pairs must be
+        # normalized to (smaller id, larger id).
+        for kind in CONTACT_KINDS:
+            new_links = links[kind]
+            old_links = self.links[kind]
+
+            self.added[kind] = new_links - old_links
+            self.removed[kind] = old_links - new_links
+            self.links[kind] = new_links
+
+            if self._graph is not None:
+                # Links that come and go between two reads cancel out
+                pending_added = self._pending_added[kind]
+                pending_removed = self._pending_removed[kind]
+
+                for link in self.removed[kind]:
+                    if link in pending_added:
+                        pending_added.discard(link)
+                    else:
+                        pending_removed.add(link)
+
+                for link in self.added[kind]:
+                    if link in pending_removed:
+                        pending_removed.discard(link)
+                    else:
+                        pending_added.add(link)
+
+    def link_array(self, kind: str):
+        # (E, 2) array of the links of one kind, sorted
+        links = self.links[kind]
+        arr = np.fromiter((i for link in links for i in link), dtype=np.int64, count=2 * len(links)).reshape(-1, 2)
+
+        return arr[np.lexsort((arr[:, 1], arr[:, 0]))]
+
+    def to_networkx(self, weight_fn=None):
+        # Live graph, patched in place on every call; copy() it to keep a step.
+        # weight_fn(kind, (E, 2) link array) -> weights refreshes edge weights.
+        if self._graph is None:
+            self._graph = nx.Graph()
+            self._graph.add_nodes_from(self.node_labels)
+
+            for kind in CONTACT_KINDS:
+                self._graph.add_edges_from(self._labels(kind, link) for link in self.links[kind])
+        else:
+            for kind in CONTACT_KINDS:
+                self._graph.remove_edges_from(self._labels(kind, link) for link in self._pending_removed[kind])
+                self._graph.add_edges_from(self._labels(kind, link) for link in self._pending_added[kind])
+
+        self._pending_added = {kind: set() for kind in CONTACT_KINDS}
+        self._pending_removed = {kind: set() for kind in CONTACT_KINDS}
+
+        if weight_fn is not None:
+            edges = self._graph.edges
+
+            for kind in CONTACT_KINDS:
+                links = self.link_array(kind)
+
+                for link, weight in zip(links.tolist(), np.asarray(weight_fn(kind, links)).tolist()):
+                    edges[self._labels(kind, link)]["weight"] = weight
+
+        return self._graph
+
+    def _node_index(self, ids, node_ids, offset: int):
+        # Positions of ids in node_ids, shifted by offset
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        order = np.argsort(node_ids, kind="stable")
+
+        return order[np.searchsorted(node_ids, ids, sorter=order)] + offset
+
+    def edge_arrays(self):
+        # (src, dst) node indices of every link, over node_labels order
+        # (UAVs first, then cars), one entry per undirected link
+        num_uavs = len(self.uav_ids)
+        sides = {"uav": (self.uav_ids, 0, self.uav_ids, 0), "uav_car": (self.uav_ids, 0, self.car_ids, num_uavs), "car": (self.car_ids, num_uavs, self.car_ids, num_uavs)}
+        src, dst = list(), list()
+
+        for kind in CONTACT_KINDS:
+            links = self.link_array(kind)
+            src_ids, src_offset, dst_ids, dst_offset = sides[kind]
+
+            src.append(self._node_index(links[:, 0], src_ids, src_offset))
+            dst.append(self._node_index(links[:, 1], dst_ids, dst_offset))
+
+        return np.concatenate(src), np.concatenate(dst)
+
+    def to_csr(self, weight_fn=None):
+        # Symmetric CSR over node_labels order (UAVs first, then cars).
+        # Returns (indptr, indices, weights); weights is None without weight_fn.
+        src, dst = self.edge_arrays()
+
+        rows = np.concatenate([src, dst])
+        cols = np.concatenate([dst, src])
+        order = np.lexsort((cols, rows))
+
+        num_nodes = len(self.uav_ids) + len(self.car_ids)
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_nodes))
+
+        if weight_fn is None:
+            return indptr, cols[order], None
+
+        weights = np.concatenate([np.asarray(weight_fn(kind, self.link_array(kind)), dtype=np.float64) for kind in CONTACT_KINDS])
+
+        return indptr, cols[order], np.concatenate([weights, weights])[order]
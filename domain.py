@@ -0,0 +1,152 @@
+import multiprocessing
+import numpy as np
+
+from topology import SquareGridRoadTopology
+from spatial import SpatialHashGrid
+
+# Halo boxes are widened by this much more than the contact range, so that
+# rounding never leaves a point in range outside its neighbour's halo
+_HALO_MARGIN = 1e-9
+
+_worker_topology = None
+
+def _init_worker(topology_rank: int, segment_len: float):
+    global _worker_topology
+    _worker_topology = SquareGridRoadTopology(topology_rank, random_weights=False, constant_weight=segment_len)
+
+def _car_contact_tile(task):
+    # Directed car contacts (src, dst) whose smaller car id the tile owns,
+    # from the tile's owned and halo cars (ascending ids)
+    ids, points, segments, owned, radius, k = task
+
+    grid = SpatialHashGrid(radius)
+    grid.rebuild(points)
+    i, j = grid.pairs_within(radius)
+
+    keep = owned[i]
+    i, j = i[keep], j[keep]
+
+    forward = _worker_topology.in_knn_segments(segments[i], segments[j], k=k)
+    backward = _worker_topology.in_knn_segments(segments[j], segments[i], k=k)
+
+    return ids[np.concatenate([i[forward], j[backward]])], ids[np.concatenate([j[forward], i[backward]])], grid.tested
+
+def _uav_contact_tile(task):
+    # Cars within range of every UAV the tile owns
+    uav_points, radii, car_ids, car_points, cell_size = task
+
+    grid = SpatialHashGrid(cell_size)
+    grid.rebuild(car_points)
+    contacts = [car_ids[grid.query_radius(coord, radius)] for coord, radius in zip(uav_points, radii.tolist())]
+
+    return contacts, grid.tested
+
+class TiledContacts(object):
+    # Contact detection split over tiles_per_side x tiles_per_side square
+    # tiles of the grid, one pool task per tile. Each step every point is
+    # owned by the tile it sits in and also sent, as halo, to the tiles whose
+    # box widened by the contact range reaches it, so every pair within range
+    # is found by the tile owning its lower id and the merged contacts are
+    # the ones a single grid finds. With processes=0 tiles run in-process.
+
+    def __init__(self, topology: SquareGridRoadTopology, tiles_per_side: int, segment_len: float, processes: int = None):
+        self.tiles_per_side = tiles_per_side
+
+        # Tiles cover the node coordinates; car real coordinates scale them
+        # by segment_len / 2
+        node_coords = topology.node_coords
+        self._lo = node_coords.min(axis=0)
+        self._hi = node_coords.max(axis=0)
+        self._segment_len = segment_len
+
+        self._pool = None
+
+        if processes != 0:
+            self._pool = multiprocessing.get_context("spawn").Pool(processes, initializer=_init_worker, initargs=(topology.num_nodes_side, segment_len))
+        else:
+            _init_worker(topology.num_nodes_side, segment_len)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _map(self, fn, tasks):
+        if self._pool is None:
+            return [fn(task) for task in tasks]
+
+        return self._pool.map(fn, tasks)
+
+    def _tiles(self, scale: float):
+        # Per axis tile edges in units of node coordinates times scale
+        return [np.linspace(self._lo[axis] * scale, self._hi[axis] * scale, self.tiles_per_side + 1) for axis in (0, 1)]
+
+    def _owner(self, points, edges):
+        tx = np.clip(np.searchsorted(edges[0], points[:, 0], side="right") - 1, 0, self.tiles_per_side - 1)
+        ty = np.clip(np.searchsorted(edges[1], points[:, 1], side="right") - 1, 0, self.tiles_per_side - 1)
+
+        return tx * self.tiles_per_side + ty
+
+    def _halo(self, points, edges, tile: int, reach: float):
+        tx, ty = divmod(tile, self.tiles_per_side)
+        reach = reach * (1 + _HALO_MARGIN) + _HALO_MARGIN
+
+        return ((points[:, 0] >= edges[0][tx] - reach) & (points[:, 0] <= edges[0][tx + 1] + reach)
+            & (points[:, 1] >= edges[1][ty] - reach) & (points[:, 1] <= edges[1][ty + 1] + reach))
+
+    def car_contacts(self, real_coord, segments, radius: float, k: int):
+        # (src, dst, pairs tested) like City._car_contact_step's directed
+        # contacts, in no particular order
+        edges = self._tiles(self._segment_len / 2)
+        owner = self._owner(real_coord, edges)
+        tasks = list()
+
+        for tile in range(self.tiles_per_side**2):
+            members = np.flatnonzero(self._halo(real_coord, edges, tile, radius))
+            tasks.append((members, real_coord[members], segments[members], owner[members] == tile, radius, k))
+
+        results = self._map(_car_contact_tile, tasks)
+
+        src = np.concatenate([r[0] for r in results])
+        dst = np.concatenate([r[1] for r in results])
+
+        return src, dst, sum(r[2] for r in results)
+
+    def uav_car_contacts(self, uav_coords, radii, car_coords, cell_size: float):
+        # Ascending ids of the cars within radii[u] of every UAV u, and the
+        # number of pairs tested; UAV and car coordinates in node units
+        uav_coords = np.asarray(uav_coords, dtype=np.float64).reshape(-1, 2)
+        radii = np.asarray(radii, dtype=np.float64)
+
+        edges = self._tiles(1)
+        owner = self._owner(uav_coords, edges)
+        reach = float(radii.max(initial=0))
+        tiles, tasks = list(), list()
+
+        for tile in range(self.tiles_per_side**2):
+            uavs = np.flatnonzero(owner == tile)
+
+            if len(uavs) == 0:
+                continue
+
+            cars = np.flatnonzero(self._halo(car_coords, edges, tile, reach))
+            tiles.append(uavs)
+            tasks.append((uav_coords[uavs], radii[uavs], cars, car_coords[cars], cell_size))
+
+        contacts = [None] * len(uav_coords)
+        tested = 0
+
+        for uavs, (tile_contacts, tile_tested) in zip(tiles, self._map(_uav_contact_tile, tasks)):
+            for uav, cars in zip(uavs.tolist(), tile_contacts):
+                contacts[uav] = cars.tolist()
+
+            tested += tile_tested
+
+        return contacts, tested
@@ -0,0 +1,89 @@
+import time
+
+class _PhaseTimer(object):
+    __slots__ = ("_stats", "_name", "_start")
+
+    def __init__(self, stats, name: str):
+        self._stats = stats
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stats._add_time(self._name, time.perf_counter() - self._start)
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+class PhaseStats(object):
+    # Cumulative wall time per phase and named counters, plus the values of
+    # the last step. Disabled stats hand out a shared no-op timer and ignore
+    # counts, so instrumented code costs one attribute check when off.
+    # Callbacks are called as callback(step, stats) at the end of every step.
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.callbacks = list()
+
+        self._timers = dict()
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.times = dict()
+        self.calls = dict()
+        self.counters = dict()
+        self.step_times = dict()
+        self.step_counters = dict()
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return _NULL_TIMER
+
+        timer = self._timers.get(name)
+
+        if timer is None:
+            timer = self._timers[name] = _PhaseTimer(self, name)
+
+        return timer
+
+    def _add_time(self, name: str, seconds: float):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.step_times[name] = self.step_times.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+            self.step_counters[name] = self.step_counters.get(name, 0) + n
+
+    def end_step(self, step: int):
+        if not self.enabled:
+            return
+
+        self.steps += 1
+
+        for callback in self.callbacks:
+            callback(step, self)
+
+        self.step_times = dict()
+        self.step_counters = dict()
+
+    def as_dict(self):
+        return {
+            "steps": self.steps,
+            "times": dict(self.times),
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+        }
@@ -0,0 +1,294 @@
+import heapq
+import numpy as np
+
+from topology import SquareGridRoadTopology
+
+class SegmentOccupancy(object):
+    # Undirected segment -> ids of the cars on it in either direction.
+    # Membership is updated when a car changes segment; the order of the cars
+    # along a segment is computed on first use and cached until positions move.
+    # Every change bumps `version` and stamps it into `changed` for the
+    # segments whose cars entered, left or moved, so anything computed from a
+    # segment stays valid while its stamp does.
+
+    def __init__(self, store):
+        self._store = store
+        self._topology = store.topology
+
+        self._members = [dict() for _ in range(len(self._topology.undirected_segments))]
+        self._car_slot = np.full(store.num_cars, -1, dtype=np.int64)
+        self._ordered = dict()
+
+        self.version = 0
+        self.changed = np.zeros(len(self._topology.undirected_segments), dtype=np.int64)
+
+    def _mark(self, slots):
+        self.version += 1
+        self.changed[slots] = self.version
+
+        for slot in np.atleast_1d(slots).tolist():
+            self._ordered.pop(slot, None)
+
+    def move(self, car_ids, segment_ids):
+        slots = self._topology.segment_undirected[segment_ids]
+        dirty = list()
+
+        for car_id, slot in zip(np.atleast_1d(car_ids).tolist(), np.atleast_1d(slots).tolist()):
+            old_slot = self._car_slot[car_id]
+
+            if old_slot == slot:
+                continue
+
+            if old_slot >= 0:
+                del self._members[old_slot][car_id]
+                dirty.append(old_slot)
+
+            self._members[slot][car_id] = None
+            self._car_slot[car_id] = slot
+            dirty.append(slot)
+
+        if len(dirty) > 0:
+            self._mark(np.unique(dirty))
+
+    def touch(self, car_ids=None):
+        # Positions of these cars (all if None) changed
+        if car_ids is None:
+            self.version += 1
+            self.changed[:] = self.version
+            self._ordered = dict()
+        else:
+            slots = self._car_slot[car_ids]
+            self._mark(np.unique(slots[slots >= 0]))
+
+    def changed_since(self, version: int):
+        # Undirected segments changed after `version`
+        return np.flatnonzero(self.changed > version)
+
+    def ordered(self, undirected_id: int):
+        # (car ids, real coords) sorted along the segment, ties by car id
+        cached = self._ordered.get(undirected_id)
+
+        if cached is None:
+            members = self._members[undirected_id]
+            car_ids = np.fromiter(members, dtype=np.int64, count=len(members))
+            real_coord = self._store.coord[car_ids] * self._store.segment_len[car_ids, None] / 2
+            axis = 0 if self._topology.segment_horizontal[self._topology.segment_ids[self._topology.undirected_segments[undirected_id]]] else 1
+
+            order = np.lexsort((car_ids, real_coord[:, axis]))
+            cached = self._ordered[undirected_id] = (car_ids[order], real_coord[order])
+
+        return cached
+
+class CarStore(object):
+    # Struct-of-arrays storage for car kinematics, one row per car id.
+    # Car objects in simulation.py are thin views over these rows.
+
+    def __init__(self, topology: SquareGridRoadTopology, num_cars: int, rng: np.random.Generator = None):
+        self.topology = topology
+        self.num_cars = num_cars
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        self.segment = np.zeros(num_cars, dtype=np.int64)
+        self.segment_loc = np.zeros(num_cars, dtype=np.float64)
+        self.segment_len = np.zeros(num_cars, dtype=np.float64)
+        self.velocity = np.zeros(num_cars, dtype=np.float64)
+        self.coord = np.zeros((num_cars, 2), dtype=np.float64)
+        self.segment_end_coord = np.zeros((num_cars, 2), dtype=np.float64)
+        self.direction_positive = np.zeros(num_cars, dtype=bool)
+        self.direction_horizontal = np.zeros(num_cars, dtype=bool)
+        self.reached_segment_end = np.zeros(num_cars, dtype=bool)
+
+        self.occupancy = SegmentOccupancy(self)
+
+    @property
+    def real_coord(self):
+        return self.coord * self.segment_len[:, None] / 2
+
+    @property
+    def plot_coord(self):
+        # Cars are drawn beside the road, on the side of their direction
+        _step = np.where(self.direction_positive, 0.2, -0.2)
+        coord = self.coord.copy()
+        coord[:, 1] += np.where(self.direction_horizontal, _step, 0)
+        coord[:, 0] += np.where(self.direction_horizontal, 0, _step)
+
+        return coord
+
+    def segment_of(self, car_id: int):
+        return self.topology.segments[self.segment[car_id]]
+
+    def set_segment(self, car_ids, segment_ids):
+        self.segment[car_ids] = segment_ids
+        self.occupancy.move(car_ids, segment_ids)
+
+    def touch(self, car_ids=None):
+        self.occupancy.touch(car_ids)
+
+    def place(self, car_ids, segment_ids, segment_locs):
+        segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        segment_locs = np.asarray(segment_locs, dtype=np.float64)
+
+        seg_lens = self.topology.segment_lens[segment_ids]
+        positive = self.topology.segment_positive[segment_ids]
+        horizontal = self.topology.segment_horizontal[segment_ids]
+
+        coord = self.topology.segment_start_coords[segment_ids].copy()
+        _step = np.where(positive, 2 * segment_locs / seg_lens, -2 * segment_locs / seg_lens)
+        coord[:, 0] += np.where(horizontal, _step, 0)
+        coord[:, 1] += np.where(horizontal, 0, _step)
+
+        self.set_segment(car_ids, segment_ids)
+        self.segment_loc[car_ids] = segment_locs
+        self.segment_len[car_ids] = seg_lens
+        self.direction_positive[car_ids] = positive
+        self.direction_horizontal[car_ids] = horizontal
+        self.coord[car_ids] = coord
+        self.segment_end_coord[car_ids] = self.topology.segment_end_coords[segment_ids]
+        self.reached_segment_end[car_ids] = segment_locs >= seg_lens
+
+        self.touch(car_ids)
+
+    def choose_next_segments(self, car_ids):
+        # Uniform choice among the successors of each car's segment, no U-turns
+        current = self.segment[car_ids]
+        counts = self.topology.next_segment_counts[current]
+        picks = (self.rng.random(len(car_ids)) * counts).astype(np.int64)
+
+        return self.topology.next_segment_table[current, picks]
+
+    def step(self):
+        # Cars at the end of their segment switch to a new one this step,
+        # every other car advances by its velocity
+        transitioning = np.flatnonzero(self.reached_segment_end)
+        moving = np.flatnonzero(~self.reached_segment_end)
+
+        self.segment_loc[moving] += self.velocity[moving]
+
+        arrived_mask = self.segment_loc[moving] >= self.segment_len[moving]
+        arrived = moving[arrived_mask]
+        advancing = moving[~arrived_mask]
+
+        self.reached_segment_end[arrived] = True
+        self.coord[arrived] = self.segment_end_coord[arrived]
+
+        vel = self.velocity[advancing]
+        seg_len = self.segment_len[advancing]
+        _step = np.where(self.direction_positive[advancing], 2 * vel / seg_len, -2 * vel / seg_len)
+        horizontal = self.direction_horizontal[advancing]
+
+        self.coord[advancing[horizontal], 0] += _step[horizontal]
+        self.coord[advancing[~horizontal], 1] += _step[~horizontal]
+
+        if len(transitioning) > 0:
+            self.place(transitioning, self.choose_next_segments(transitioning), np.zeros(len(transitioning)))
+
+        self.touch(moving)
+
+        return transitioning
+
+    def _along_road(self, car_ids, ticks):
+        # segment_loc and the coordinate along the road of every car after
+        # 0, 1, ..., ticks - 1 ticks on its current segment, summed tick by
+        # tick like step() so the floats agree
+        vel = self.velocity[car_ids]
+        seg_len = self.segment_len[car_ids]
+        axis = np.where(self.direction_horizontal[car_ids], 0, 1)
+        _step = np.where(self.direction_positive[car_ids], 2 * vel / seg_len, -2 * vel / seg_len)
+
+        locs = np.add.accumulate(np.concatenate([self.segment_loc[car_ids, None], np.repeat(vel[:, None], ticks - 1, axis=1)], axis=1), axis=1)
+        coords = np.add.accumulate(np.concatenate([self.coord[car_ids, axis][:, None], np.repeat(_step[:, None], ticks - 1, axis=1)], axis=1), axis=1)
+
+        return locs, coords, axis
+
+    def _ticks_to_end(self, car_ids):
+        # Tick on which every car reaches the end of its current segment, -1
+        # for cars that never do
+        loc0 = self.segment_loc[car_ids]
+        vel = self.velocity[car_ids]
+        seg_len = self.segment_len[car_ids]
+        moving = vel > 0
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            width = int(np.ceil(np.max(np.where(moving, (seg_len - loc0) / vel, 0), initial=0))) + 2
+
+        while True:
+            locs = np.add.accumulate(np.concatenate([loc0[:, None], np.repeat(vel[:, None], width - 1, axis=1)], axis=1), axis=1)
+            arrived = locs[:, 1:] >= seg_len[:, None]
+
+            if arrived[moving].any(axis=1).all():
+                break
+
+            width *= 2
+
+        return np.where(moving & arrived.any(axis=1), np.argmax(arrived, axis=1) + 1, -1)
+
+    def advance(self, ticks: int):
+        # Same state as `ticks` calls of step(), event by event: a priority
+        # queue holds the ticks on which cars leave their segment, and only
+        # those cars are touched on each one. Between events a car's row
+        # keeps where it started on its segment; positions after the last
+        # tick are summed from there once. Next segments are drawn in
+        # (tick, car id) order like step() does. Returns the number of
+        # segment transitions.
+        start = np.zeros(self.num_cars, dtype=np.int64)
+        ends = np.full(self.num_cars, -1, dtype=np.int64)
+        followed = np.zeros(self.num_cars, dtype=bool)
+
+        pending = dict()
+        queue = list()
+
+        def schedule(car_ids, at):
+            keep = (at > 0) & (at <= ticks)
+            car_ids, at = car_ids[keep], at[keep]
+            order = np.argsort(at, kind="stable")
+            car_ids, at = car_ids[order], at[order]
+            ticks_at, firsts = np.unique(at, return_index=True)
+
+            for t, group in zip(ticks_at.tolist(), np.split(car_ids, firsts[1:])):
+                if t not in pending:
+                    pending[t] = list()
+                    heapq.heappush(queue, t)
+
+                pending[t].append(group)
+
+        def follow(car_ids, tick: int):
+            # Cars starting a fresh stretch of road at tick
+            ticks_to_end = self._ticks_to_end(car_ids)
+            start[car_ids] = tick
+            ends[car_ids] = ticks_to_end
+            followed[car_ids] = True
+
+            schedule(car_ids, np.where(ticks_to_end > 0, tick + ticks_to_end + 1, -1))
+
+        waiting = np.flatnonzero(self.reached_segment_end)
+        schedule(waiting, np.ones(len(waiting), dtype=np.int64))
+        follow(np.flatnonzero(~self.reached_segment_end), 0)
+
+        transitions = 0
+
+        while len(queue) > 0:
+            tick = heapq.heappop(queue)
+            car_ids = np.sort(np.concatenate(pending.pop(tick)))
+
+            self.place(car_ids, self.choose_next_segments(car_ids), np.zeros(len(car_ids)))
+            follow(car_ids, tick)
+            transitions += len(car_ids)
+
+        # State after the last tick, from where each car started its segment
+        car_ids = np.flatnonzero(followed)
+        elapsed = ticks - start[car_ids]
+        car_ends = ends[car_ids]
+        arrived = (car_ends > 0) & (elapsed >= car_ends)
+        at = np.where(arrived, car_ends, np.where(self.velocity[car_ids] > 0, elapsed, 0))
+
+        locs, coords, axis = self._along_road(car_ids, int(at.max(initial=0)) + 1)
+        rows = np.arange(len(car_ids))
+
+        self.segment_loc[car_ids] = locs[rows, at]
+        self.reached_segment_end[car_ids] = arrived
+        self.coord[car_ids, axis] = coords[rows, at]
+        self.coord[car_ids[arrived]] = self.segment_end_coord[car_ids[arrived]]
+
+        self.touch()
+
+        return transitions
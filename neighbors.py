@@ -0,0 +1,302 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+from spatial import scalar_distances
+
+# Candidates this close to the best vectorized distance are compared with the
+# scalar distance, which is what decides ties in the per-car loops
+TIE_MARGIN = 1e-12
+
+def _expand(queries, starts, stops):
+    # (query, entry) for every entry of the ranges [starts, stops)
+    counts = np.maximum(stops - starts, 0)
+    entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    return np.repeat(queries, counts), entries
+
+def _block_search(values, lo, hi, x, right: bool = False):
+    # np.searchsorted(values[lo:hi], x) + lo for every query at once
+    lo = lo.copy()
+    hi = hi.copy()
+    last = max(len(values) - 1, 0)
+
+    while True:
+        active = lo < hi
+
+        if not active.any():
+            return lo
+
+        mid = (lo + hi) // 2
+        v = values[np.minimum(mid, last)]
+        go_right = active & ((v <= x) if right else (v < x))
+
+        lo = np.where(go_right, mid + 1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+
+def _pick_candidates(num_queries: int, queries, member_ids, member_coords, ranks, points, farthest: bool = False):
+    # Best candidate per query, the way the per-car loops choose it: nearest
+    # takes the first of equally near candidates in list order (rank),
+    # farthest the last of equally far ones. Returns (ids, distances), -1 and
+    # inf (nearest) or 0 (farthest) for queries without candidates.
+    ids = np.full(num_queries, -1, dtype=np.int64)
+    dists = np.full(num_queries, 0.0 if farthest else np.inf)
+
+    if len(queries) == 0:
+        return ids, dists
+
+    dx = points[queries, 0] - member_coords[:, 0]
+    dy = points[queries, 1] - member_coords[:, 1]
+    approx = (dx**2 + dy**2)**.5
+
+    if farthest:
+        best = np.full(num_queries, -np.inf)
+        np.maximum.at(best, queries, approx)
+        close = approx >= best[queries] * (1 - TIE_MARGIN)
+    else:
+        best = np.full(num_queries, np.inf)
+        np.minimum.at(best, queries, approx)
+        close = approx <= best[queries] * (1 + TIE_MARGIN)
+
+    queries = queries[close]
+    member_ids = member_ids[close]
+    ranks = ranks[close]
+    exact = scalar_distances(dx[close], dy[close])
+
+    if farthest:
+        order = np.lexsort((-ranks, -exact, queries))
+    else:
+        order = np.lexsort((ranks, exact, queries))
+
+    queries = queries[order]
+    first = np.concatenate([[True], queries[1:] != queries[:-1]])
+    chosen = order[first]
+
+    ids[queries[first]] = member_ids[chosen]
+    dists[queries[first]] = exact[chosen]
+
+    return ids, dists
+
+class ContactIndex(object):
+    # Per step lookups over contact lists (owner -> member ids, CSR). Every
+    # owner's members are kept sorted by position along the owner's road
+    # axis, and again per (owner, undirected segment). When an owner's
+    # members share the other coordinate, as car contacts on the grid do,
+    # the distance to a point only grows with the gap along the axis and a
+    # nearest query is a binary search; other blocks are scanned whole.
+
+    def __init__(self, indptr, indices, coords, axes=None, segments=None):
+        indptr = np.asarray(indptr, dtype=np.int64)
+        indices = np.asarray(indices, dtype=np.int64)
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+
+        num_owners = len(indptr) - 1
+        counts = np.diff(indptr)
+        owners = np.repeat(np.arange(num_owners), counts)
+        ranks = np.arange(len(indices)) - indptr[owners]
+
+        self.num_owners = num_owners
+        self.coords = coords
+
+        if axes is None:
+            pos = np.zeros(len(indices))
+            collinear = np.zeros(num_owners, dtype=bool)
+        else:
+            axes = np.asarray(axes, dtype=np.int64)
+            member_coords = coords[indices]
+            pos = member_coords[np.arange(len(indices)), axes[owners]]
+            perp = member_coords[np.arange(len(indices)), 1 - axes[owners]]
+
+            collinear = np.ones(num_owners, dtype=bool)
+            occupied = np.flatnonzero(counts > 0)
+            collinear[occupied] = np.minimum.reduceat(perp, indptr[occupied]) == np.maximum.reduceat(perp, indptr[occupied])
+
+        self.axes = axes
+        self.collinear = collinear
+        self._lists = None
+
+        order = np.lexsort((ranks, pos, owners))
+        self.indptr = indptr
+        self.member_ids = indices[order]
+        self.member_pos = pos[order]
+        self.member_ranks = ranks[order]
+
+        if segments is not None:
+            segments = np.asarray(segments, dtype=np.int64)
+            member_segments = segments[indices]
+            self.num_segments = int(segments.max(initial=0)) + 1
+
+            order = np.lexsort((ranks, pos, member_segments, owners))
+            keys = owners[order] * self.num_segments + member_segments[order]
+
+            self.segment_keys, self.segment_starts = np.unique(keys, return_index=True)
+            self.segment_stops = np.append(self.segment_starts[1:], len(keys))
+            self.segment_member_ids = indices[order]
+            self.segment_member_pos = pos[order]
+            self.segment_member_ranks = ranks[order]
+
+    def _segment_blocks(self, owners, segments):
+        # [lo, hi) of every (owner, segment) block, empty if it has no members
+        lo = np.zeros(len(owners), dtype=np.int64)
+        hi = np.zeros(len(owners), dtype=np.int64)
+
+        if len(self.segment_keys) == 0:
+            return lo, hi
+
+        keys = owners * self.num_segments + segments
+        at = np.minimum(np.searchsorted(self.segment_keys, keys), len(self.segment_keys) - 1)
+        found = (segments >= 0) & (segments < self.num_segments) & (self.segment_keys[at] == keys)
+
+        lo[found] = self.segment_starts[at[found]]
+        hi[found] = self.segment_stops[at[found]]
+
+        return lo, hi
+
+    def _nearest_in_blocks(self, owners, points, lo, hi, member_ids, member_pos, member_ranks):
+        num_queries = len(owners)
+        starts, stops = lo.copy(), hi.copy()
+
+        # Sorted blocks: only members about as near as the ones either side of
+        # the point along the axis need a distance
+        sorted_block = self.collinear[owners] & (hi > lo)
+
+        if sorted_block.any():
+            q = np.flatnonzero(sorted_block)
+            axes = self.axes[owners[q]]
+            a = points[q, axes]
+            offset = points[q, 1 - axes] - self.coords[member_ids[lo[q]], 1 - axes]
+            at = _block_search(member_pos, lo[q], hi[q], a)
+
+            gap = np.full(len(q), np.inf)
+            left = at > lo[q]
+            right = at < hi[q]
+            gap[left] = a[left] - member_pos[at[left] - 1]
+            gap[right] = np.minimum(gap[right], member_pos[at[right]] - a[right])
+
+            best = (gap**2 + offset**2)**.5
+            reach = np.maximum((best * (1 + TIE_MARGIN))**2 - offset**2, 0)**.5 + TIE_MARGIN
+            starts[q] = _block_search(member_pos, lo[q], hi[q], a - reach)
+            stops[q] = _block_search(member_pos, lo[q], hi[q], a + reach, right=True)
+
+        queries, entries = _expand(np.arange(num_queries), starts, stops)
+
+        return _pick_candidates(num_queries, queries, member_ids[entries], self.coords[member_ids[entries]], member_ranks[entries], points)
+
+    def nearest(self, owners, points):
+        # Member of each owner's list nearest to each point
+        owners = np.asarray(owners, dtype=np.int64)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+        return self._nearest_in_blocks(owners, points, self.indptr[owners], self.indptr[owners + 1], self.member_ids, self.member_pos, self.member_ranks)
+
+    def nearest_on_segments(self, owners, points, segments):
+        # Same, among the members on the given undirected segments
+        owners = np.asarray(owners, dtype=np.int64)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        lo, hi = self._segment_blocks(owners, np.asarray(segments, dtype=np.int64))
+
+        return self._nearest_in_blocks(owners, points, lo, hi, self.segment_member_ids, self.segment_member_pos, self.segment_member_ranks)
+
+    def farthest_on_segments(self, owners, points, segments):
+        # Member on the given undirected segments farthest from each point
+        owners = np.asarray(owners, dtype=np.int64)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        lo, hi = self._segment_blocks(owners, np.asarray(segments, dtype=np.int64))
+
+        queries, entries = _expand(np.arange(len(owners)), lo, hi)
+        member_ids = self.segment_member_ids[entries]
+
+        return _pick_candidates(len(owners), queries, member_ids, self.coords[member_ids], self.segment_member_ranks[entries], points, farthest=True)
+
+    # Single queries walk the same blocks as Python lists with bisect, which
+    # beats numpy call overhead for one query at a time
+
+    def _as_lists(self):
+        if self._lists is None:
+            lists = {
+                "coords": self.coords.tolist(),
+                "axes": self.axes.tolist() if self.axes is not None else None,
+                "collinear": self.collinear.tolist(),
+                "indptr": self.indptr.tolist(),
+                "ids": self.member_ids.tolist(),
+                "pos": self.member_pos.tolist(),
+                "ranks": self.member_ranks.tolist(),
+            }
+
+            if hasattr(self, "segment_keys"):
+                lists.update({
+                    "segment_keys": self.segment_keys.tolist(),
+                    "segment_starts": self.segment_starts.tolist(),
+                    "segment_stops": self.segment_stops.tolist(),
+                    "segment_ids": self.segment_member_ids.tolist(),
+                    "segment_pos": self.segment_member_pos.tolist(),
+                    "segment_ranks": self.segment_member_ranks.tolist(),
+                })
+
+            self._lists = lists
+
+        return self._lists
+
+    def _segment_block(self, owner: int, segment: int):
+        lists = self._as_lists()
+        keys = lists["segment_keys"]
+        key = owner * self.num_segments + segment
+        at = bisect_left(keys, key)
+
+        if segment < 0 or segment >= self.num_segments or at == len(keys) or keys[at] != key:
+            return 0, 0
+
+        return lists["segment_starts"][at], lists["segment_stops"][at]
+
+    def _nearest_one_in_block(self, owner: int, point, lo: int, hi: int, ids: list, pos: list, ranks: list):
+        lists = self._as_lists()
+        coords = lists["coords"]
+
+        if lists["collinear"][owner] and hi > lo:
+            axis = lists["axes"][owner]
+            a = point[axis]
+            offset = point[1 - axis] - coords[ids[lo]][1 - axis]
+            at = bisect_left(pos, a, lo, hi)
+
+            gap = min(a - pos[at - 1] if at > lo else float("inf"), pos[at] - a if at < hi else float("inf"))
+            best = (gap**2 + offset**2)**.5
+            reach = max((best * (1 + TIE_MARGIN))**2 - offset**2, 0)**.5 + TIE_MARGIN
+
+            lo, hi = bisect_left(pos, a - reach, lo, hi), bisect_right(pos, a + reach, lo, hi)
+
+        best_id, best_rank, min_distance = -1, -1, float("inf")
+
+        for e in range(lo, hi):
+            coord = coords[ids[e]]
+            dist = ((point[0] - coord[0])**2 + (point[1] - coord[1])**2)**.5
+
+            if dist < min_distance or (dist == min_distance and ranks[e] < best_rank):
+                best_id, best_rank, min_distance = ids[e], ranks[e], dist
+
+        return best_id, min_distance
+
+    def nearest_one(self, owner: int, point):
+        lists = self._as_lists()
+        return self._nearest_one_in_block(owner, point, lists["indptr"][owner], lists["indptr"][owner + 1], lists["ids"], lists["pos"], lists["ranks"])
+
+    def nearest_one_on_segment(self, owner: int, point, segment: int):
+        lists = self._as_lists()
+        lo, hi = self._segment_block(owner, segment)
+        return self._nearest_one_in_block(owner, point, lo, hi, lists["segment_ids"], lists["segment_pos"], lists["segment_ranks"])
+
+    def farthest_one_on_segment(self, owner: int, point, segment: int):
+        lists = self._as_lists()
+        coords = lists["coords"]
+        ids = lists["segment_ids"]
+        ranks = lists["segment_ranks"]
+
+        best_id, best_rank, max_distance = -1, -1, 0
+
+        for e in range(*self._segment_block(owner, segment)):
+            coord = coords[ids[e]]
+            dist = ((point[0] - coord[0])**2 + (point[1] - coord[1])**2)**.5
+
+            if dist > max_distance or (dist == max_distance and ranks[e] > best_rank):
+                best_id, best_rank, max_distance = ids[e], ranks[e], dist
+
+        return best_id, max_distance
@@ -0,0 +1,247 @@
+import io
+import shutil
+import warnings
+import subprocess
+import collections
+import multiprocessing
+import numpy as np
+import networkx as nx
+
+FRAME_RATE = 10
+
+class StepSnapshot(object):
+    # Everything needed to draw one step, detached from the City. Coordinates
+    # are plot coordinates; links are (L, 2, 2) arrays of line end points.
+
+    def __init__(self, step: int, car_ids: list, car_coords, car_colors: list, uav_ids: list, uav_coords, uav_colors: list,
+            car_links, uav_car_links, uav_links, sparse_rects: list, network_nodes: list = None, network_edges: list = None):
+        self.step = step
+        self.car_ids = car_ids
+        self.car_coords = car_coords
+        self.car_colors = car_colors
+        self.uav_ids = uav_ids
+        self.uav_coords = uav_coords
+        self.uav_colors = uav_colors
+        self.car_links = car_links
+        self.uav_car_links = uav_car_links
+        self.uav_links = uav_links
+        self.sparse_rects = sparse_rects
+        self.network_nodes = network_nodes
+        self.network_edges = network_edges
+
+def draw_city(plt, topology, snapshot: StepSnapshot):
+    ax = plt.gca()
+
+    topology.plot()
+
+    for x, y, width, height in snapshot.sparse_rects:
+        ax.add_patch(plt.Rectangle((x, y), width=width, height=height, fc=(1,0,0,0.5), zorder=1000))
+
+    for (x0, y0), (x1, y1) in snapshot.car_links.tolist():
+        plt.plot([x0, x1], [y0, y1], "g--")
+
+    for (x0, y0), (x1, y1) in snapshot.uav_car_links.tolist():
+        plt.plot([x0, x1], [y0, y1], "r--")
+
+    for (x0, y0), (x1, y1) in snapshot.uav_links.tolist():
+        plt.plot([x0, x1], [y0, y1], "b--")
+
+    for car_id, car_coord, car_color in zip(snapshot.car_ids, snapshot.car_coords.tolist(), snapshot.car_colors):
+        ax.add_patch(plt.Circle(car_coord, radius=.17, color=car_color, zorder=1000))
+        ax.annotate(car_id, xy=car_coord, fontsize=12, color="white", #ha="center")
+            verticalalignment='center', horizontalalignment='center', zorder=1001)
+
+    for uav_id, uav_coord, uav_color in zip(snapshot.uav_ids, snapshot.uav_coords.tolist(), snapshot.uav_colors):
+        ax.add_patch(plt.Circle(uav_coord, radius=.25, color=uav_color, zorder=1000))
+        ax.annotate(uav_id, xy=uav_coord, fontsize=13, color="white", #ha="center")
+            verticalalignment='center', horizontalalignment='center', zorder=1001)
+
+def draw_network(plt, nodes: list, edges: list):
+    topology = nx.Graph()
+    topology.add_nodes_from(nodes)
+    topology.add_weighted_edges_from(edges)
+
+    pos = nx.circular_layout(topology)
+    nx.draw(topology, pos, with_labels=True, node_size=1000, font_size=15)
+    labels = nx.get_edge_attributes(topology, 'weight')
+    nx.draw_networkx_edge_labels(topology, pos, edge_labels=labels)
+    plt.draw()
+
+def canvas_rgba(figure):
+    figure.canvas.draw()
+    return np.asarray(figure.canvas.buffer_rgba())
+
+class FFmpegFrameWriter(object):
+    # Streams figure canvases as raw RGBA frames into an ffmpeg process.
+    # Nothing is kept between frames, so memory stays flat however long the
+    # run is. The output container follows the file extension (.mp4, .gif, ...).
+
+    def __init__(self, filename: str, fps: int = FRAME_RATE, ffmpeg_bin: str = "ffmpeg"):
+        self.filename = filename
+        self.fps = fps
+        self.ffmpeg_bin = ffmpeg_bin
+
+        self._proc = None
+        self._frame_shape = None
+
+    def _open(self, width: int, height: int):
+        cmd = [self.ffmpeg_bin, "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{width}x{height}", "-r", str(self.fps), "-i", "-"]
+
+        if not self.filename.endswith(".gif"):
+            cmd += ["-movflags", "faststart", "-pix_fmt", "yuv420p", "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2"]
+
+        self._proc = subprocess.Popen(cmd + [self.filename], stdin=subprocess.PIPE)
+
+    def append(self, figure):
+        self.append_frame(canvas_rgba(figure))
+
+    def append_frame(self, frame):
+        if self._proc is None:
+            self._frame_shape = frame.shape
+            self._open(frame.shape[1], frame.shape[0])
+        elif frame.shape != self._frame_shape:
+            raise ValueError(f"Frame size changed from {self._frame_shape} to {frame.shape}")
+
+        self._proc.stdin.write(np.ascontiguousarray(frame).data)
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+
+            if self._proc.wait() != 0:
+                raise RuntimeError(f"ffmpeg exited with code {self._proc.returncode} while writing {self.filename}")
+
+            self._proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class PillowGifWriter(object):
+    # Fallback when ffmpeg is not installed: keeps PNG encoded frames and
+    # writes the GIF with Pillow on close, so memory grows with the step count
+
+    def __init__(self, filename: str, fps: int = FRAME_RATE):
+        self.filename = filename
+        self.fps = fps
+
+        self._frames = list()
+
+    def append(self, figure):
+        buf = io.BytesIO()
+        figure.savefig(buf, format="png")
+        buf.seek(0)
+
+        self._frames.append(buf)
+
+    def append_frame(self, frame):
+        from PIL import Image
+
+        buf = io.BytesIO()
+        Image.fromarray(np.ascontiguousarray(frame[:, :, :3])).save(buf, format="png")
+        buf.seek(0)
+
+        self._frames.append(buf)
+
+    def close(self):
+        from PIL import Image
+
+        if len(self._frames) > 0:
+            images = [Image.open(buf) for buf in self._frames]
+            images[0].save(self.filename, save_all=True, append_images=images[1:], duration=int(1000 / self.fps))
+
+        self._frames = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_frame_writer(filename: str, fps: int = FRAME_RATE):
+    if shutil.which("ffmpeg") is not None:
+        return FFmpegFrameWriter(filename, fps=fps)
+
+    if not filename.endswith(".gif"):
+        raise RuntimeError(f"ffmpeg is required to write {filename}")
+
+    warnings.warn(f"ffmpeg not found, {filename} is written with Pillow, which keeps every frame in memory until the end of the run")
+
+    return PillowGifWriter(filename, fps=fps)
+
+_render_worker = dict()
+
+def _init_render_worker(topology, figsize: tuple, dpi: float):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    _render_worker["plt"] = plt
+    _render_worker["topology"] = topology
+    _render_worker["figure"] = plt.figure(figsize=figsize, dpi=dpi)
+
+def _render_snapshot(snapshot: StepSnapshot):
+    plt = _render_worker["plt"]
+    figure = _render_worker["figure"]
+
+    plt.figure(figure.number)
+    plt.clf()
+    draw_city(plt, _render_worker["topology"], snapshot)
+    city_frame = canvas_rgba(figure).copy()
+
+    plt.clf()
+    draw_network(plt, snapshot.network_nodes, snapshot.network_edges)
+    network_frame = canvas_rgba(figure).copy()
+
+    return city_frame, network_frame
+
+class ParallelFrameRenderer(object):
+    # Renders StepSnapshots on a process pool and hands the frames to the
+    # writers in step order. At most max_pending snapshots are in flight.
+
+    def __init__(self, topology, figsize: tuple, dpi: float, city_writer, network_writer, processes: int = None, max_pending: int = None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        if max_pending is None:
+            max_pending = 2 * processes
+
+        self.city_writer = city_writer
+        self.network_writer = network_writer
+        self.max_pending = max_pending
+
+        self._pending = collections.deque()
+        self._pool = multiprocessing.get_context("spawn").Pool(processes, initializer=_init_render_worker, initargs=(topology, figsize, dpi))
+
+    def _write_oldest(self):
+        city_frame, network_frame = self._pending.popleft().get()
+
+        self.city_writer.append_frame(city_frame)
+        self.network_writer.append_frame(network_frame)
+
+    def submit(self, snapshot: StepSnapshot):
+        self._pending.append(self._pool.apply_async(_render_snapshot, (snapshot,)))
+
+        while len(self._pending) > self.max_pending:
+            self._write_oldest()
+
+    def close(self):
+        if self._pool is None:
+            return
+
+        try:
+            while len(self._pending) > 0:
+                self._write_oldest()
+        finally:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,15 +1,23 @@
-import os
 import sys
+import shutil
 from simulation import City
+from telemetry import JsonlSink, TelemetryPublisher
 
 if __name__ == "__main__":
     cars = int(sys.argv[1]) 
     rank = int(sys.argv[2]) 
     steps = int(sys.argv[3]) 
+    render_processes = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    telemetry_file_name = sys.argv[5] if len(sys.argv) > 5 else None
 
-    gif_file_name = f"sim_{cars}_{rank}_{steps}.gif"
+    # Without ffmpeg only GIFs can be written
+    video_file_name = f"sim_{cars}_{rank}_{steps}.{'mp4' if shutil.which('ffmpeg') is not None else 'gif'}"
 
     c = City(cars, rank)
-    c.save_simulation_with_graphics(steps, gif_file_name)
+    publisher = TelemetryPublisher(c, JsonlSink(telemetry_file_name)) if telemetry_file_name is not None else None
 
-    os.system(f'ffmpeg -i {gif_file_name} -movflags faststart -pix_fmt yuv420p -vf "scale=trunc(iw/2)*2:trunc(ih/2)*2" sim_{cars}_{rank}_{steps}.mp4')
\ No newline at end of file
+    try:
+        c.save_simulation_with_graphics(steps, video_file_name, render_processes=render_processes)
+    finally:
+        if publisher is not None:
+            publisher.close()
@@ -1,16 +1,20 @@
-import io
+import os
+import json
 import math
-import copy
-import pickle
-import random
+import contextlib
 import numpy as np
-from PIL import Image
-import networkx as nx
-from progress.bar import Bar
-import matplotlib.pyplot as plt
 from datetime import datetime as dt
 
 from topology import SquareGridRoadTopology
+from kinematics import CarStore
+from spatial import SpatialHashGrid, scalar_pow, scalar_distances
+from contact_graph import ContactGraph
+from connectivity import contact_connectivity
+from neighbors import ContactIndex, TIE_MARGIN
+from domain import TiledContacts
+from step_trace import TraceWriter, lists_to_csr, csr_to_lists
+from instrumentation import PhaseStats
+from rendering import StepSnapshot, ParallelFrameRenderer, open_frame_writer, draw_city, draw_network
 
 UAV_RADIUS = 2.15
 UAV_DISP_RANGE = (.0, .1)
@@ -26,28 +30,47 @@ CAR_NEAR_INTERSECTION_THRESH = 1
 
 SPARSE_INTERVAL_RECT_HEIGHT_WIDTH = .5
 
+CHECKPOINT_VERSION = 1
+
 real_coord_to_plot_coord = lambda t: (t[0] * 2 / SEGMENT_LENS, t[1] * 2 / SEGMENT_LENS)
 square_distance = lambda x1, y1, x2, y2: ((x1 - x2)**2 + (y1 - y2)**2)**.5
 
-class City(object):
-    CAR_COLORS = ["b", "g", "c", "m", "y", "k", "b"]
+def _road_slices(rel_pos, span, segments=None):
+    # Slice index of positions measured from the lower joint of a segment,
+    # or -1 outside it. Slices are [kR, (k+1)R] with R = ROAD_SLICING_RANGE,
+    # a position on a border counts in the lower slice. span may be per
+    # segment, indexed by segments.
+    num_slices = np.ceil(np.asarray(span) / ROAD_SLICING_RANGE).astype(np.int64)
+    rel_pos = np.asarray(rel_pos)
 
-    def __init__(self, num_cars: int, topology_rank: int):
-        plt.figure(figsize=(max(1.5 * topology_rank, 12), max(1.5 * topology_rank, 12)))
-        #plt.rcParams["figure.figsize"] = (1.5 * topology_rank, 1.5 * topology_rank)
+    slices = np.maximum(np.ceil(rel_pos / ROAD_SLICING_RANGE) - 1, 0).astype(np.int64)
+    inside = (rel_pos >= 0) & (slices < (num_slices if segments is None else num_slices[segments]))
 
-        self.num_cars = num_cars
-        self.topology_rank = topology_rank
+    return num_slices, np.where(inside, slices, -1)
 
-        self.topology = SquareGridRoadTopology(topology_rank, random_weights=False, constant_weight=SEGMENT_LENS)
+def _query_result(found_id: int, dist: float, missing=float("inf")):
+    # ContactIndex answers use -1 for no match
+    if found_id < 0:
+        return (None, missing)
+
+    return (found_id, dist)
+
+class City(object):
+    CAR_COLORS = ["b", "g", "c", "m", "y", "k", "b"]
+
+    def __init__(self, num_cars: int, topology_rank: int, vectorized: bool = True, headless: bool = False, seed: int = None):
+        self._init_world(num_cars, topology_rank, vectorized, headless, seed)
 
-        self.cars = dict()
         _road_segments = self.topology.road_segments
 
+        _segment_ids = self.car_rng.integers(0, len(_road_segments), num_cars).tolist()
+        _segment_points = self.car_rng.integers(0, self.topology.segment_lens[_segment_ids].astype(np.int64) + 1).tolist()
+        _velocities = (self.car_rng.integers(1500, 2001, num_cars) / 100).tolist()
+
         for i in range(num_cars):
-            random_segment = random.choice(_road_segments)
+            random_segment = _road_segments[_segment_ids[i]]
             segment_len = self.topology.adj[random_segment[0]][random_segment[1]]
-            random_segment_point = random.randint(0, segment_len)
+            random_segment_point = _segment_points[i]
 
             car_coord = list(self.topology._G_pos[random_segment[0]])
             segment_end_coord = list(self.topology._G_pos[random_segment[1]])
@@ -66,11 +89,10 @@ class City(object):
 
             self.cars[i] = Car(self, car_id=i, segment=random_segment,
                 segment_loc=random_segment_point, segment_len=segment_len,
-                car_velocity=random.randint(1500, 2000) / 100, car_color=self.CAR_COLORS[i % len(self.CAR_COLORS)],
+                car_velocity=_velocities[i], car_color=self.CAR_COLORS[i % len(self.CAR_COLORS)],
                 car_coord=car_coord, car_direction_positive=car_direction_positive,
                 car_direction_horizontal=car_direction_horizontal, segment_end_coord=segment_end_coord)
 
-        self.uavs = dict()
         _uav_index = 0
 
         for i in range(1, 2*(topology_rank-1), 2):
@@ -79,34 +101,113 @@ class City(object):
                     self.CAR_COLORS[i % len(self.CAR_COLORS)])
                 _uav_index += 1
 
+        self._init_runtime()
+
+    def _init_world(self, num_cars: int, topology_rank: int, vectorized: bool, headless: bool, seed):
+        self.num_cars = num_cars
+        self.topology_rank = topology_rank
+        self.vectorized = vectorized
+        self.headless = headless
+
+        # Plotting stack is imported on first use; headless cities never
+        # touch matplotlib unless something is actually rendered
+        self._figure_num = None
+
+        if not headless:
+            self._ensure_figure()
+
+        # All randomness comes from this seed, through independent child
+        # streams for cars and UAVs. Without a seed one is drawn from the OS
+        # and kept in self.seed so the run can be repeated.
+        seed_sequence = np.random.SeedSequence(seed)
+        car_seed, uav_seed = seed_sequence.spawn(2)
+
+        self.seed = seed_sequence.entropy
+        self.car_rng = np.random.default_rng(car_seed)
+        self.uav_rng = np.random.default_rng(uav_seed)
+
+        self.topology = SquareGridRoadTopology(topology_rank, random_weights=False, constant_weight=SEGMENT_LENS)
+
+        self.car_store = CarStore(self.topology, num_cars, rng=self.car_rng)
+        self.cars = dict()
+        self.uavs = dict()
+
+    def _init_runtime(self):
+        self.uav_grid = SpatialHashGrid(UAV_RADIUS)
+        self.car_grid = SpatialHashGrid(UAV_RADIUS)
+        self.car_contact_grid = SpatialHashGrid(CAR_CONTACT_RANGE_AS_ROAD_UNITS)
+
+        # Set by decompose() to run contact detection over tiles of the grid
+        self.domain = None
+
+        self.step_count = 0
+
+        # Per phase timers and counters of simulation_step, off by default;
+        # set stats.enabled and read stats or register stats.callbacks
+        self.stats = PhaseStats()
+
+        self.contact_graph = ContactGraph(list(self.uavs.keys()), list(self.cars.keys()))
+        self._contact_graph_step = None
+
+        # Segment metrics are cached against SegmentOccupancy versions and
+        # only recomputed for segments whose cars changed since
+        self._step_metrics = None
+        self._step_metrics_version = None
+        self._step_sparse_intervals = None
+        self._step_sparse_intervals_version = None
+        self._segment_cache = dict()
+        self._step_start_version = self.car_store.occupancy.version
+        self._connectivity = None
+        self._connectivity_step = None
+        self._contact_indexes = None
+        self._contact_indexes_step = None
+
+    @property
+    def figure_size(self):
+        return (max(1.5 * self.topology_rank, 12), max(1.5 * self.topology_rank, 12))
+
+    def _ensure_figure(self):
+        import matplotlib.pyplot as plt
+
+        if self._figure_num is None:
+            self._figure_num = plt.figure(figsize=self.figure_size).number
+            #plt.rcParams["figure.figsize"] = (1.5 * topology_rank, 1.5 * topology_rank)
+        else:
+            plt.figure(self._figure_num)
+
+        return plt
+
     def _real_coord_of_joint(self, joint_id: int):
         return (self.topology._G_pos[joint_id][0] * SEGMENT_LENS / 2, self.topology._G_pos[joint_id][1] * SEGMENT_LENS / 2)
 
-    def _cars_in_segment(self, segment: tuple):
-        car_ids = []
-
-        for car_id, car in self.cars.items():
-            if car.segment == segment or car.segment == (segment[1], segment[0]):
-                car_ids.append(car_id)
+    def _undirected_segment_id(self, segment: tuple):
+        return self.topology.segment_undirected[self.topology.segment_ids[segment]]
 
-        return car_ids
+    def _cars_in_segment(self, segment: tuple):
+        # Cars on the segment in either direction, ordered along the segment
+        car_ids, _ = self.car_store.occupancy.ordered(self._undirected_segment_id(segment))
+        return car_ids.tolist()
 
     def sorted_table_of_density(self, segment: tuple):
-        assets = [
+        axis = 0 if self.topology.is_segment_horizontal(segment) else 1
+
+        joint_assets = sorted([
             (self._real_coord_of_joint(segment[0]), "i", segment[0]),
             (self._real_coord_of_joint(segment[1]), "i", segment[1]),
-        ]
+        ], key=lambda x: x[0][axis])
 
-        assets += [(self.cars[car_id].real_coord, "c", car_id) for car_id in self._cars_in_segment(segment)]
+        car_ids, real_coords = self.car_store.occupancy.ordered(self._undirected_segment_id(segment))
+        car_assets = [(coord, "c", car_id) for coord, car_id in zip(real_coords.tolist(), car_ids.tolist())]
 
-        if self.topology.is_segment_horizontal(segment):
-            assets = sorted(assets, key=lambda x: x[0][0])
-        else:
-            assets = sorted(assets, key=lambda x: x[0][1])
+        # Intersections go before cars sitting exactly on them
+        lo, hi = np.searchsorted(real_coords[:, axis], [joint_assets[0][0][axis], joint_assets[1][0][axis]], side="left").tolist()
 
-        return assets
+        return car_assets[:lo] + [joint_assets[0]] + car_assets[lo:hi] + [joint_assets[1]] + car_assets[hi:]
 
     def segment_connectedness(self, segment):
+        return self._segment_cached("segment_connectedness", segment, self._segment_connectedness)
+
+    def _segment_connectedness(self, segment):
         rv_over_dists = []
         tod = self.sorted_table_of_density(segment)
 
@@ -131,6 +232,9 @@ class City(object):
         return abs(mult)
 
     def segment_sparse_intervals(self, segment: tuple):
+        return list(self._segment_cached("segment_sparse_intervals", segment, self._segment_sparse_intervals))
+
+    def _segment_sparse_intervals(self, segment: tuple):
         rv_over_dists = []
         tod = self.sorted_table_of_density(segment)
 
@@ -158,93 +262,294 @@ class City(object):
         if segment[0] > segment[1]:
             segment = (segment[1], segment[0]) # Normalize
 
-        car_ids = self._cars_in_segment(segment)
-        area_freqs = dict()
+        axis = 0 if self.topology.is_segment_horizontal(segment) else 1
+        lower_coord = self._real_coord_of_joint(segment[0])[axis]
+        upper_coord_max = self._real_coord_of_joint(segment[1])[axis]
+
+        _, real_coords = self.car_store.occupancy.ordered(self._undirected_segment_id(segment))
+        num_slices, slices = _road_slices(real_coords[:, axis] - lower_coord, upper_coord_max - lower_coord)
 
-        if self.topology.is_segment_horizontal(segment):
-            lower_x_coord = self._real_coord_of_joint(segment[0])[0]
-            upper_x_coord = lower_x_coord + ROAD_SLICING_RANGE
-            upper_x_coord_max = self._real_coord_of_joint(segment[1])[0]
+        return dict(enumerate(np.bincount(slices[slices >= 0], minlength=int(num_slices)).tolist()))
 
-            area_index = 0
-            added_ids = set()
+    def average_num_vehicles_per_area(self, segment: tuple):
+        return self._segment_cached("average_num_vehicles_per_area", segment, self._average_num_vehicles_per_area)
 
-            while upper_x_coord < (upper_x_coord_max + ROAD_SLICING_RANGE):
-                area_freqs[area_index] = 0
+    def _average_num_vehicles_per_area(self, segment: tuple):
+        area_freq = self._num_cars_in_segment_areas(segment)
+        return sum(area_freq.values()) / len(area_freq.keys())
 
-                for car_id in car_ids:
-                    if lower_x_coord <= self.cars[car_id].real_coord[0] <= upper_x_coord:
-                        area_freqs[area_index] += 1
+    def std_area_densities(self, segment: tuple):
+        return self._segment_cached("std_area_densities", segment, self._std_area_densities)
 
-                        added_ids.add(car_id)
-                
-                for car_id in added_ids:
-                    car_ids.remove(car_id)
+    def _std_area_densities(self, segment: tuple):
+        area_freq = self._num_cars_in_segment_areas(segment)
+        mu = sum(area_freq.values()) / len(area_freq.keys())
 
-                lower_x_coord = upper_x_coord
-                upper_x_coord = lower_x_coord + ROAD_SLICING_RANGE
+        return (sum([(f - mu)**2 for f in area_freq.values()]) / len(area_freq.keys()))**.5
 
-                added_ids = set()
-                area_index += 1
+    def _segment_density_pass(self, segments=None):
+        # One pass over every unique road segment, or over the given unique
+        # segment ids, which are then numbered 0.. in that order. Intersections
+        # and cars are sorted by (segment, position along it) together,
+        # intersections first on ties like sorted_table_of_density, and
+        # consecutive entries give the gaps.
+        topology = self.topology
+        joint_real_coords = topology.node_coords * SEGMENT_LENS / 2
+        car_segments = topology.segment_undirected[self.car_store.segment]
+
+        if segments is None:
+            num_segments = len(topology.undirected_segments)
+            joints = topology.undirected_segment_nodes
+            horizontal = topology.undirected_horizontal
+            car_ids = np.arange(len(car_segments))
+            car_real_coords = self.car_store.real_coord
         else:
-            lower_y_coord = self._real_coord_of_joint(segment[0])[1]
-            upper_y_coord = lower_y_coord + ROAD_SLICING_RANGE
-            upper_y_coord_max = self._real_coord_of_joint(segment[1])[1]
+            segments = np.asarray(segments, dtype=np.int64)
+            num_segments = len(segments)
+            joints = topology.undirected_segment_nodes[segments]
+            horizontal = topology.undirected_horizontal[segments]
+
+            local = np.full(len(topology.undirected_segments), -1, dtype=np.int64)
+            local[segments] = np.arange(num_segments)
+            car_ids = np.flatnonzero(local[car_segments] >= 0)
+            car_segments = local[car_segments[car_ids]]
+            car_real_coords = self.car_store.real_coord[car_ids]
+
+        entry_segments = np.concatenate([np.arange(num_segments), np.arange(num_segments), car_segments])
+        entry_coords = np.concatenate([joint_real_coords[joints[:, 0]], joint_real_coords[joints[:, 1]], car_real_coords])
+        entry_is_car = np.concatenate([np.zeros(2 * num_segments, dtype=bool), np.ones(len(car_segments), dtype=bool)])
+        entry_ids = np.concatenate([joints[:, 0], joints[:, 1], car_ids])
+        entry_pos = np.where(horizontal[entry_segments], entry_coords[:, 0], entry_coords[:, 1])
+
+        order = np.lexsort((entry_ids, entry_is_car, entry_pos, entry_segments))
+        entry_segments = entry_segments[order]
+        entry_coords = entry_coords[order]
+
+        pair_starts = np.flatnonzero(entry_segments[:-1] == entry_segments[1:])
+        c0 = entry_coords[pair_starts]
+        c1 = entry_coords[pair_starts + 1]
+
+        same = (c0[:, 0] == c1[:, 0]) & (c0[:, 1] == c1[:, 1])
+        dx = c0[:, 0] - c1[:, 0]
+        dy = c0[:, 1] - c1[:, 1]
+        sq_dist = np.where(same, CAR_CONTACT_RANGE_AS_ROAD_UNITS, (dx**2 + dy**2)**.5)
+
+        # Ratios this close to an integer can floor differently than in
+        # segment_connectedness, those gaps are measured the scalar way
+        ratios = CAR_CONTACT_RANGE_AS_ROAD_UNITS / sq_dist
+        unsure = np.flatnonzero(~same & (np.abs(ratios - np.round(ratios)) <= 1e-12 * np.maximum(ratios, 1)))
+        sq_dist[unsure] = scalar_distances(dx[unsure], dy[unsure])
+
+        factors = np.floor(CAR_CONTACT_RANGE_AS_ROAD_UNITS / sq_dist)
+
+        return {
+            "order": order,
+            "entry_segments": entry_segments,
+            "entry_coords": entry_coords,
+            "entry_is_car": entry_is_car[order],
+            "entry_ids": entry_ids[order],
+            "pair_starts": pair_starts,
+            "pair_segments": entry_segments[pair_starts],
+            "factors": factors,
+            "car_segments": car_segments,
+            "car_real_coords": car_real_coords,
+        }
+
+    def segment_metrics(self, include_tables: bool = False, segments=None):
+        # connectedness, anvpa and stdds of every unique road segment in one
+        # pass, in unique_road_segments order, or of the given unique segment
+        # ids only. With include_tables the sorted tables of density ("stod")
+        # are built as well. Connectedness is a float here and saturates to
+        # inf where the exact product overflows.
+        topology = self.topology
+        unique_ids = np.arange(len(topology.undirected_segments)) if segments is None else np.asarray(segments, dtype=np.int64)
+        num_segments = len(unique_ids)
+        density = self._segment_density_pass(segments)
+
+        pair_offsets = np.searchsorted(density["pair_segments"], np.arange(num_segments))
+
+        with np.errstate(over="ignore", invalid="ignore"):
+            connectedness = np.multiply.reduceat(density["factors"], pair_offsets)
+
+        connectedness[np.minimum.reduceat(density["factors"], pair_offsets) == 0] = 0
+
+        # Road slices
+        joints = topology.undirected_segment_nodes[unique_ids]
+        axis = np.where(topology.undirected_horizontal[unique_ids], 0, 1)
+        joint_real_coords = topology.node_coords * SEGMENT_LENS / 2
+        lower_coords = joint_real_coords[joints[:, 0], axis]
+        upper_coords = joint_real_coords[joints[:, 1], axis]
+
+        car_segments = density["car_segments"]
+        car_pos = density["car_real_coords"][np.arange(len(car_segments)), axis[car_segments]]
+
+        num_slices, slices = _road_slices(car_pos - lower_coords[car_segments], upper_coords - lower_coords, car_segments)
+        slice_offsets = np.concatenate([[0], np.cumsum(num_slices)[:-1]])
+        counted = slices >= 0
+
+        slice_freqs = np.bincount(slice_offsets[car_segments[counted]] + slices[counted], minlength=int(num_slices.sum()))
+        anvpa = np.bincount(car_segments[counted], minlength=num_segments) / num_slices
+
+        slice_segments = np.repeat(np.arange(num_segments), num_slices)
+        slice_index = np.arange(len(slice_segments)) - slice_offsets[slice_segments]
+
+        # Squared deviations are added slice by slice, in the order
+        # std_area_densities sums them, so both give the same floats
+        deviations = np.zeros((int(num_slices.max(initial=0)), num_segments))
+        # Few distinct (count, mean) pairs, so their squares are taken the
+        # scalar way like in std_area_densities
+        offsets, inverse = np.unique(slice_freqs - anvpa[slice_segments], return_inverse=True)
+        deviations[slice_index, slice_segments] = scalar_pow(offsets, 2)[inverse]
+        sq_sums = np.zeros(num_segments)
+
+        for row in deviations:
+            sq_sums = sq_sums + row
+
+        stdds = scalar_pow(sq_sums / num_slices, .5)
+
+        metrics = {
+            "connectedness": connectedness,
+            "anvpa": anvpa,
+            "stdds": stdds,
+        }
+
+        if include_tables:
+            entry_offsets = np.searchsorted(density["entry_segments"], np.arange(num_segments + 1))
+            coords = density["entry_coords"].tolist()
+            is_car = density["entry_is_car"].tolist()
+            ids = density["entry_ids"].tolist()
+
+            metrics["stod"] = [[(coords[i] if is_car[i] else tuple(coords[i]), "c" if is_car[i] else "i", ids[i]) for i in range(entry_offsets[u], entry_offsets[u + 1])]
+                for u in range(num_segments)]
+
+        return metrics
+
+    def all_segment_sparse_intervals(self, segments=None):
+        # segment_sparse_intervals of every unique road segment (or of the
+        # given unique segment ids) in one pass
+        density = self._segment_density_pass(segments)
+        sparse = np.flatnonzero(density["factors"] == 0)
+
+        coords = density["entry_coords"]
+        starts = density["pair_starts"][sparse]
+        ret = [list() for _ in range(len(self.topology.undirected_segments) if segments is None else len(segments))]
+
+        for u, c0, c1 in zip(density["pair_segments"][sparse].tolist(), coords[starts].tolist(), coords[starts + 1].tolist()):
+            ret[u].append((c0, c1))
 
-            area_index = 0
-            added_ids = set()
+        return ret
 
-            while upper_y_coord < (upper_y_coord_max + ROAD_SLICING_RANGE):
-                area_freqs[area_index] = 0
+    def score_g(self, segment: tuple, target_section: tuple):
+        Dw1 = self.topology.distance(segment[0], target_section[0])
+        Dw2 = self.topology.distance(segment[0], target_section[1])
+        Dw3 = self.topology.distance(segment[1], target_section[0])
+        Dw4 = self.topology.distance(segment[1], target_section[1])
 
-                for car_id in car_ids:
-                    if lower_y_coord <= self.cars[car_id].real_coord[1] <= upper_y_coord:
-                        area_freqs[area_index] += 1
+        Dw = (Dw1 + Dw2 + Dw3 + Dw4) / 4
 
-                        added_ids.add(car_id)
-                
-                for car_id in added_ids:
-                    car_ids.remove(car_id)
+        return (self.segment_connectedness(segment) * CAR_CONTACT_RANGE_AS_ROAD_UNITS) / ((1 + self.std_area_densities(segment)) * Dw)
 
-                lower_y_coord = upper_y_coord
-                upper_y_coord = lower_y_coord + ROAD_SLICING_RANGE
+    def step_segment_metrics(self):
+        # segment_metrics() of the current state. Values of segments whose
+        # cars have not entered, left or moved since the last call are kept,
+        # the rest are recomputed; arrays handed out are never changed.
+        occupancy = self.car_store.occupancy
 
-                added_ids = set()
-                area_index += 1
+        if self._step_metrics is None:
+            self._step_metrics = self.segment_metrics()
+        elif self._step_metrics_version != occupancy.version:
+            dirty = occupancy.changed_since(self._step_metrics_version)
 
-        return area_freqs
+            if len(dirty) > 0:
+                fresh = self.segment_metrics(segments=dirty)
+                self._step_metrics = {name: values.copy() for name, values in self._step_metrics.items()}
 
-    def average_num_vehicles_per_area(self, segment: tuple):
-        area_freq = self._num_cars_in_segment_areas(segment)
-        return sum(area_freq.values()) / len(area_freq.keys())
+                for name, values in fresh.items():
+                    self._step_metrics[name][dirty] = values
 
-    def std_area_densities(self, segment: tuple):
-        mu = self.average_num_vehicles_per_area(segment)
-        area_freq = self._num_cars_in_segment_areas(segment)
+        self._step_metrics_version = occupancy.version
 
-        return (sum([(f - mu)**2 for f in area_freq.values()]) / len(area_freq.keys()))**.5
+        return self._step_metrics
 
-    def score_g(self, segment: tuple, target_section: tuple):
-        Dw1 = nx.shortest_path_length(self.topology.G, source=segment[0], target=target_section[0])
-        Dw2 = nx.shortest_path_length(self.topology.G, source=segment[0], target=target_section[1])
-        Dw3 = nx.shortest_path_length(self.topology.G, source=segment[1], target=target_section[0])
-        Dw4 = nx.shortest_path_length(self.topology.G, source=segment[1], target=target_section[1])
+    def step_sparse_intervals(self):
+        # all_segment_sparse_intervals() of the current state, recomputed
+        # for changed segments only like step_segment_metrics
+        occupancy = self.car_store.occupancy
 
-        Dw = (Dw1 + Dw2 + Dw3 + Dw4) / 4
+        if self._step_sparse_intervals is None:
+            self._step_sparse_intervals = self.all_segment_sparse_intervals()
+        elif self._step_sparse_intervals_version != occupancy.version:
+            dirty = occupancy.changed_since(self._step_sparse_intervals_version)
 
-        return (self.segment_connectedness(segment) * CAR_CONTACT_RANGE_AS_ROAD_UNITS) / ((1 + self.std_area_densities(segment)) * Dw)
+            if len(dirty) > 0:
+                self._step_sparse_intervals = list(self._step_sparse_intervals)
 
-    def simulation_step(self):
-        for uav in self.uavs.values():
-            uav.simulation_step()
+                for u, intervals in zip(dirty.tolist(), self.all_segment_sparse_intervals(dirty)):
+                    self._step_sparse_intervals[u] = intervals
+
+        self._step_sparse_intervals_version = occupancy.version
+
+        return self._step_sparse_intervals
+
+    def dirty_segments(self):
+        # Unique segment ids whose cars entered, left or moved during the
+        # last simulation_step
+        return self.car_store.occupancy.changed_since(self._step_start_version)
+
+    def _segment_cached(self, name: str, segment: tuple, compute):
+        # compute(segment), kept per unique segment until its cars change;
+        # both directions of a segment share the value
+        u = self._undirected_segment_id(segment)
+        version = self.car_store.occupancy.changed[u]
+        cached = self._segment_cache.get((name, u))
 
+        if cached is None or cached[0] != version:
+            cached = self._segment_cache[(name, u)] = (version, compute(segment))
+
+        return cached[1]
+
+    def next_intersections_to_targets(self, car_ids: list, target_sections: list):
+        # Car.next_intersection_to_target_segment for many (car, target
+        # section) queries at once. Candidates are the segments leaving either
+        # end of the car's segment, scored like score_g from the step's cached
+        # segment metrics; the first best one wins, None when it scores 0.
+        topology = self.topology
+        metrics = self.step_segment_metrics()
+
+        car_ids = np.asarray(car_ids, dtype=np.int64)
+        targets = np.asarray(target_sections, dtype=np.int64).reshape(-1, 2)
+        car_nodes = topology.segment_nodes[self.car_store.segment[car_ids]]
+
+        candidates = np.concatenate([topology.out_segment_table[car_nodes[:, 1]], topology.out_segment_table[car_nodes[:, 0]]], axis=1)
+        valid = candidates >= 0
+        candidates = np.where(valid, candidates, 0)
+
+        u = topology.segment_undirected[candidates]
+        s0 = topology.segment_nodes[candidates, 0]
+        s1 = topology.segment_nodes[candidates, 1]
+        t0 = targets[:, 0, None]
+        t1 = targets[:, 1, None]
+
+        Dw = (topology.hop_distances(s0, t0) + topology.hop_distances(s0, t1) + topology.hop_distances(s1, t0) + topology.hop_distances(s1, t1)) / 4
+
+        with np.errstate(invalid="ignore"):
+            scores = (metrics["connectedness"][u] * CAR_CONTACT_RANGE_AS_ROAD_UNITS) / ((1 + metrics["stdds"][u]) * Dw)
+
+        scores = np.where(valid, scores, -np.inf)
+        best = np.argmax(scores, axis=1)
+        rows = np.arange(len(car_ids))
+
+        return [None if score == 0 else joint for score, joint in zip(scores[rows, best].tolist(), s1[rows, best].tolist())]
+
+    def _scalar_car_step(self):
         for car in self.cars.values():
             if car.reached_segment_end:
                 # No explicit looping
                 different_segments = self.topology.neighbor_segments_to(car.segment)
                 different_segments.remove((car.segment[1], car.segment[0]))
 
-                next_random_segment = random.choice(different_segments)       
+                # Same draw as CarStore.choose_next_segments
+                next_random_segment = different_segments[int(self.car_rng.random() * len(different_segments))]
                 new_segment_len = self.topology.adj[next_random_segment[0]][next_random_segment[1]]
 
                 new_car_coord = list(self.topology._G_pos[next_random_segment[0]])      
@@ -255,25 +560,154 @@ class City(object):
                 #print(f"Car #{car.car_id} {car.segment} => {next_random_segment}")
 
                 car.update(next_random_segment, 0, new_segment_len, new_direction_positive, new_direction_horizontal, new_car_coord, new_segment_end_coord)
+                self.stats.count("segment_transitions")
             else:
                 car.simulation_step()
                 #print(f"Car #{car.car_id} {car.segment} {100 * car.segment_loc/car.segment_len}% ({car.segment_loc}/{car.segment_len})")
 
-        for uav in self.uavs.values():
-            contact_uavs = [k for k, v in self.uavs.items() if (v.uav_id != uav.uav_id) and (uav.distance_to(v.coord) <= uav.radius_of_operation)]
-            contact_cars = [k for k, v in self.cars.items() if uav.distance_to(v.car_coord) <= uav.radius_of_operation]
+    def _uav_contact_step(self):
+        uav_ids = list(self.uavs.keys())
+        car_ids = list(self.cars.keys())
+
+        self.uav_grid.rebuild([uav.coord for uav in self.uavs.values()])
+
+        if self.domain is not None:
+            tile_contacts, tested = self.domain.uav_car_contacts([uav.coord for uav in self.uavs.values()],
+                [uav.radius_of_operation for uav in self.uavs.values()], self.car_store.coord[car_ids], UAV_RADIUS)
+            self.stats.count("uav_car_pairs_tested", tested)
+        else:
+            self.car_grid.rebuild(self.car_store.coord[car_ids])
+
+        for n, uav in enumerate(self.uavs.values()):
+            contact_uavs = [uav_ids[i] for i in self.uav_grid.query_radius(uav.coord, uav.radius_of_operation).tolist() if uav_ids[i] != uav.uav_id]
+
+            if self.domain is not None:
+                contact_cars = [car_ids[i] for i in tile_contacts[n]]
+            else:
+                contact_cars = [car_ids[i] for i in self.car_grid.query_radius(uav.coord, uav.radius_of_operation).tolist()]
 
             uav.update_contacts(contact_cars, contact_uavs)
 
-        for car in self.cars.values():
-            new_contacts = list()
-            knn_segments = self.topology.knn_segments_of(car.segment, k=CAR_CONTACT_SEGMENT_RANGE)
+            self.stats.count("uav_contacts", len(contact_uavs))
+            self.stats.count("uav_car_contacts", len(contact_cars))
+
+        self.stats.count("uav_pairs_tested", self.uav_grid.tested)
+
+        if self.domain is None:
+            self.stats.count("uav_car_pairs_tested", self.car_grid.tested)
+
+    def _car_contact_step(self):
+        # Cars within range on each other's k-nearest segments. Close pairs
+        # come from a grid with range sized cells, the segment condition is
+        # then checked for each direction of every pair.
+        car_segments = self.car_store.segment
+
+        if self.domain is not None:
+            src, dst, tested = self.domain.car_contacts(self.car_store.real_coord, car_segments, CAR_CONTACT_RANGE_AS_ROAD_UNITS, CAR_CONTACT_SEGMENT_RANGE)
+        else:
+            self.car_contact_grid.rebuild(self.car_store.real_coord)
+            i, j = self.car_contact_grid.pairs_within(CAR_CONTACT_RANGE_AS_ROAD_UNITS)
+            tested = self.car_contact_grid.tested
+
+            forward = self.topology.in_knn_segments(car_segments[i], car_segments[j], k=CAR_CONTACT_SEGMENT_RANGE)
+            backward = self.topology.in_knn_segments(car_segments[j], car_segments[i], k=CAR_CONTACT_SEGMENT_RANGE)
+
+            src = np.concatenate([i[forward], j[backward]])
+            dst = np.concatenate([j[forward], i[backward]])
 
-            for _car_id, _car in self.cars.items():
-                if (_car_id != car.car_id) and (_car.segment in knn_segments) and (car.real_distance_to(_car) <= CAR_CONTACT_RANGE_AS_ROAD_UNITS):
-                    new_contacts.append(_car_id)
+        order = np.lexsort((dst, src))
 
-            car.update_contacts(new_contacts)
+        indptr = np.zeros(self.car_store.num_cars + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(src, minlength=self.car_store.num_cars))
+
+        contacts = csr_to_lists(indptr, dst[order])
+
+        self.stats.count("car_pairs_tested", tested)
+        self.stats.count("car_contacts", len(src))
+
+        for car_id, car in self.cars.items():
+            car.update_contacts(contacts[car_id])
+
+    def decompose(self, tiles_per_side: int, processes: int = None):
+        # Runs contact detection over tiles_per_side**2 tiles of the grid on a
+        # pool of processes (domain.TiledContacts); contacts are unchanged.
+        # Motion and all random draws stay here, in car and UAV id order, so
+        # a decomposed run matches a single process one step for step. Only
+        # contact detection is split, and the speedup over one process has
+        # not been measured. tiles_per_side=None goes back to a single
+        # process.
+        self.close()
+
+        if tiles_per_side is not None:
+            self.domain = TiledContacts(self.topology, tiles_per_side, SEGMENT_LENS, processes)
+
+    def close(self):
+        if self.domain is not None:
+            self.domain.close()
+            self.domain = None
+
+    def _uav_movement_step(self):
+        # One batch of UAV displacement draws per step, whether or not a
+        # UAV ends up using its share
+        num_uavs = len(self.uavs)
+        disp_ranges = np.array([[int(x * 1000) for x in uav.random_displacement_range] for uav in self.uavs.values()], dtype=np.int64).reshape(-1, 2)
+        rolls = (self.uav_rng.integers(0, 101, num_uavs) / 100).tolist()
+        angles = self.uav_rng.integers(0, 361, num_uavs).tolist()
+        disps = (self.uav_rng.integers(disp_ranges[:, 0], disp_ranges[:, 1] + 1) / 1000).tolist()
+
+        for uav, roll, angle, disp in zip(self.uavs.values(), rolls, angles, disps):
+            uav.simulation_step(roll, angle, disp)
+
+    def advance(self, steps: int):
+        # The state `steps` calls of simulation_step would leave, for runs
+        # that only look at every n-th step. Contacts are found for the last
+        # step only, as nothing in between depends on them, and cars move
+        # event by event (CarStore.advance). UAVs draw every step and still
+        # move step by step. Counts as a single step in stats.
+        if steps <= 0:
+            return
+
+        self._step_start_version = self.car_store.occupancy.version
+        stats = self.stats
+
+        with stats.phase("uav_movement"):
+            for _ in range(steps):
+                self._uav_movement_step()
+
+        with stats.phase("car_movement"):
+            stats.count("segment_transitions", self.car_store.advance(steps))
+
+        self.step_count += steps
+
+        with stats.phase("uav_contacts"):
+            self._uav_contact_step()
+
+        with stats.phase("car_contacts"):
+            self._car_contact_step()
+
+        stats.end_step(self.step_count)
+
+    def simulation_step(self):
+        self.step_count += 1
+        self._step_start_version = self.car_store.occupancy.version
+        stats = self.stats
+
+        with stats.phase("uav_movement"):
+            self._uav_movement_step()
+
+        with stats.phase("car_movement"):
+            if self.vectorized:
+                stats.count("segment_transitions", len(self.car_store.step()))
+            else:
+                self._scalar_car_step()
+
+        with stats.phase("uav_contacts"):
+            self._uav_contact_step()
+
+        with stats.phase("car_contacts"):
+            self._car_contact_step()
+
+        stats.end_step(self.step_count)
 
         #for unique_segment in self.topology.unique_road_segments:
         #    print(unique_segment, self.segment_connectedness(unique_segment), self.sorted_table_of_density(unique_segment), self._num_cars_in_segment_areas(unique_segment))
@@ -282,157 +716,369 @@ class City(object):
         #print()
         #print()
 
-    def plot(self):
-        ax = plt.gca()
+    def snapshot(self, step: int = None, include_network: bool = True):
+        car_ids = list(self.cars.keys())
+        car_plot_coords = self.car_store.plot_coord
+        car_index = {car_id: i for i, car_id in enumerate(car_ids)}
 
-        self.topology.plot()
+        uav_ids = list(self.uavs.keys())
+        uav_coords = np.array([uav.coord for uav in self.uavs.values()], dtype=np.float64).reshape(-1, 2)
+        uav_index = {uav_id: i for i, uav_id in enumerate(uav_ids)}
 
-        for unique_segment in self.topology.unique_road_segments:
-            sparse_intervals = self.segment_sparse_intervals(unique_segment)
+        sparse_rects = list()
 
+        for unique_segment, sparse_intervals in zip(self.topology.unique_road_segments, self.step_sparse_intervals()):
             for interval in sparse_intervals:
+                int0_coord = real_coord_to_plot_coord(interval[0])
+                int1_coord = real_coord_to_plot_coord(interval[1])
+
                 if self.topology.is_segment_horizontal(unique_segment):
-                    int0_coord = real_coord_to_plot_coord(interval[0])
-                    int1_coord = real_coord_to_plot_coord(interval[1])
-                    ax.add_patch(plt.Rectangle((int0_coord[0], int0_coord[1] - (SPARSE_INTERVAL_RECT_HEIGHT_WIDTH / 2)), width=int1_coord[0]-int0_coord[0], height=SPARSE_INTERVAL_RECT_HEIGHT_WIDTH, fc=(1,0,0,0.5), zorder=1000))
+                    sparse_rects.append((int0_coord[0], int0_coord[1] - (SPARSE_INTERVAL_RECT_HEIGHT_WIDTH / 2), int1_coord[0]-int0_coord[0], SPARSE_INTERVAL_RECT_HEIGHT_WIDTH))
                 else:
-                    int0_coord = real_coord_to_plot_coord(interval[0])
-                    int1_coord = real_coord_to_plot_coord(interval[1])
-                    ax.add_patch(plt.Rectangle((int0_coord[0] - (SPARSE_INTERVAL_RECT_HEIGHT_WIDTH / 2), int0_coord[1]), width=SPARSE_INTERVAL_RECT_HEIGHT_WIDTH, height=int1_coord[1]-int0_coord[1], fc=(1,0,0,0.5), zorder=1000))
+                    sparse_rects.append((int0_coord[0] - (SPARSE_INTERVAL_RECT_HEIGHT_WIDTH / 2), int0_coord[1], SPARSE_INTERVAL_RECT_HEIGHT_WIDTH, int1_coord[1]-int0_coord[1]))
 
-        car_plot_pairs = list()
+        car_pairs = [(car_index[car.car_id], car_index[car_id]) for car in self.cars.values() for car_id in car.cars_in_contact if car.car_id < car_id or car.car_id not in self.cars[car_id].cars_in_contact]
+        uav_car_pairs = [(uav_index[uav.uav_id], car_index[car_id]) for uav in self.uavs.values() for car_id in uav.cars_in_contact]
+        uav_pairs = [(uav_index[uav.uav_id], uav_index[uav_id]) for uav in self.uavs.values() for uav_id in uav.uavs_in_contact if uav.uav_id < uav_id or uav.uav_id not in self.uavs[uav_id].uavs_in_contact]
 
-        for car in self.cars.values():
-            for car_id in car.cars_in_contact:
-                if ((car_id, car.car_id) not in car_plot_pairs) and (((car.car_id, car_id) not in car_plot_pairs)):
-                    _car = self.cars[car_id]
-                    car_coord = _car.plot_coord
-                    self_coord = car.plot_coord
-                    plt.plot([self_coord[0], car_coord[0]], [self_coord[1], car_coord[1]], "g--")
-                    car_plot_pairs.append((car.car_id, car_id))
-
-        uav_plot_pairs = list()
-
-        for uav in self.uavs.values():
-            for car_id in uav.cars_in_contact:
-                _car = self.cars[car_id]
-                car_coord = _car.plot_coord
-                plt.plot([uav.coord[0], car_coord[0]], [uav.coord[1], car_coord[1]], "r--")
-            for uav_id in uav.uavs_in_contact:
-                if ((uav_id, uav.uav_id) not in uav_plot_pairs) and (((uav.uav_id, uav_id) not in uav_plot_pairs)):
-                    _uav = self.uavs[uav_id]
-                    plt.plot([uav.coord[0], _uav.coord[0]], [uav.coord[1], _uav.coord[1]], "b--")
-                    uav_plot_pairs.append((uav.uav_id, uav_id))
+        car_pairs = np.array(car_pairs, dtype=np.int64).reshape(-1, 2)
+        uav_car_pairs = np.array(uav_car_pairs, dtype=np.int64).reshape(-1, 2)
+        uav_pairs = np.array(uav_pairs, dtype=np.int64).reshape(-1, 2)
 
-        for car in self.cars.values():
-            car_coord = car.plot_coord
+        network_nodes = None
+        network_edges = None
 
-            ax.add_patch(plt.Circle(car_coord, radius=.17, color=car.car_color, zorder=1000))
-            ax.annotate(car.car_id, xy=car_coord, fontsize=12, color="white", #ha="center")
-                verticalalignment='center', horizontalalignment='center', zorder=1001)
+        if include_network:
+            network = self.current_network_topology
+            network_nodes = list(network.nodes)
+            network_edges = list(network.edges(data="weight"))
 
-            #plt.plot(car_coord[0], car_coord[1], car.car_color + "o")
-            #plt.text(car_coord[0], car_coord[1], car.car_id, fontsize=10)
+        return StepSnapshot(step, car_ids, car_plot_coords[car_ids], [car.car_color for car in self.cars.values()],
+            uav_ids, uav_coords, [uav.uav_color for uav in self.uavs.values()],
+            np.stack([car_plot_coords[car_pairs[:, 0]], car_plot_coords[car_pairs[:, 1]]], axis=1),
+            np.stack([uav_coords[uav_car_pairs[:, 0]], car_plot_coords[uav_car_pairs[:, 1]]], axis=1),
+            np.stack([uav_coords[uav_pairs[:, 0]], uav_coords[uav_pairs[:, 1]]], axis=1),
+            sparse_rects, network_nodes, network_edges)
 
-        for uav in self.uavs.values():
-            ax.add_patch(plt.Circle(uav.coord, radius=.25, color=uav.uav_color, zorder=1000))
-            ax.annotate(uav.uav_id, xy=uav.coord, fontsize=13, color="white", #ha="center")
-                verticalalignment='center', horizontalalignment='center', zorder=1001)
+    def plot(self):
+        plt = self._ensure_figure()
+        draw_city(plt, self.topology, self.snapshot(include_network=False))
 
     def show_plot(self):
+        plt = self._ensure_figure()
         plt.show()
 
-    def save_simulation_with_graphics(self, steps: int, filename: str = "out.gif", data_out_filename: str = None):
-        with Bar("Processing", max=steps+2) as bar:
-            images = list()
-            topo_images = list()
-
-            sim_iters = dict()
-
+    def save_simulation_with_graphics(self, steps: int, filename: str = "out.gif", data_out_filename: str = None, render_processes: int = 1, render: bool = True):
+        from progress.bar import Bar
+
+        if data_out_filename is None:
+            data_out_filename = f"trace_{self.num_cars}_{self.topology_rank}_{str(dt.now().timestamp()).split('.')[0]}"
+
+        # Frames are streamed to the encoders as they are drawn. With more
+        # than one render process, steps are drawn from snapshots on a pool.
+        # Step data is appended to a columnar trace directory; with
+        # render=False that trace is the only output.
+        with Bar("Processing", max=steps+2) as bar, \
+                (open_frame_writer(filename) if render else contextlib.nullcontext()) as writer, \
+                (open_frame_writer(os.path.join(os.path.dirname(filename), f"topology_{os.path.basename(filename)}")) if render else contextlib.nullcontext()) as topo_writer, \
+                TraceWriter(data_out_filename, meta=self.trace_meta) as trace_writer, \
+                (self._frame_renderer(writer, topo_writer, render_processes) if render else contextlib.nullcontext()) as renderer:
             for step_index in range(1, steps + 1):
-                plt.clf()
-
                 self.simulation_step()
-                self.plot()
-
-                buf = io.BytesIO()
-                plt.savefig(buf, format="png")
-                buf.seek(0)
-                images.append(Image.open(buf))
-
-                plt.clf()
-
-                self.plot_network_topology()
-                buf = io.BytesIO()
-                plt.savefig(buf, format="png")
-                buf.seek(0)
-                topo_images.append(Image.open(buf))
-
-                step_data = {
-                    "network": self.current_network_topology,
-                    "cars": copy.deepcopy(self.cars),
-                    "uavs": copy.deepcopy(self.uavs),
-                    "metrics": {segment: {
-                        "stod": self.sorted_table_of_density(segment),
-                        "connectedness": self.segment_connectedness(segment),
-                        "anvpa": self.average_num_vehicles_per_area(segment),
-                        "stdds": self.std_area_densities(segment)
-                    } for segment in self.topology.unique_road_segments}
-                }
-
-                sim_iters[step_index] = step_data
 
-                bar.next()
+                if render:
+                    if renderer is not None:
+                        renderer.submit(self.snapshot(step_index))
+                    else:
+                        plt = self._ensure_figure()
+                        plt.clf()
 
-            images[0].save(filename, save_all=True, append_images=images)
-            topo_images[0].save(f"topology_{filename}", save_all=True, append_images=topo_images)
-            bar.next()
+                        self.plot()
+                        writer.append(plt.gcf())
 
-            if data_out_filename is None:
-                data_out_filename = f"dump_{self.num_cars}_{self.topology_rank}_{str(dt.now().timestamp()).split('.')[0]}.pkl"
+                        plt.clf()
 
-            with open(data_out_filename, "wb") as fp:
-                pickle.dump(sim_iters, fp, protocol=pickle.HIGHEST_PROTOCOL)
+                        self.plot_network_topology()
+                        topo_writer.append(plt.gcf())
+
+                trace_writer.append(step_index, self.step_record())
+
+                bar.next()
 
             bar.next()
+            trace_writer.flush()
+            bar.next()
+
+    @property
+    def trace_meta(self):
+        return {
+            "num_cars": self.num_cars,
+            "num_uavs": len(self.uavs),
+            "topology_rank": self.topology_rank,
+            "seed": self.seed,
+            "segments": self.topology.segments,
+            "unique_road_segments": self.topology.unique_road_segments,
+            "car_colors": [car.car_color for car in self.cars.values()],
+            "uav_colors": [uav.uav_color for uav in self.uavs.values()],
+        }
+
+    def step_record(self):
+        # Columns appended to the trace for the current step. Directed segment
+        # ids index trace_meta["segments"]; contacts are CSR over car/UAV ids.
+        record = {
+            "car_segment": self.car_store.segment.astype(np.int32),
+            "car_segment_loc": self.car_store.segment_loc.copy(),
+            "car_coord": self.car_store.coord.copy(),
+            "uav_coord": np.array([uav.coord for uav in self.uavs.values()], dtype=np.float64).reshape(-1, 2),
+            "car_contacts": lists_to_csr([car.cars_in_contact for car in self.cars.values()]),
+            "uav_car_contacts": lists_to_csr([uav.cars_in_contact for uav in self.uavs.values()]),
+            "uav_contacts": lists_to_csr([uav.uavs_in_contact for uav in self.uavs.values()]),
+        }
+
+        record.update(self.step_segment_metrics())
+
+        return record
+
+    def save_checkpoint(self, filename: str):
+        # Everything simulation_step depends on, as arrays plus a JSON header
+        # in one compressed .npz: car rows, UAV state, contacts (CSR), RNG
+        # states and the step counter. The topology is rebuilt from its rank.
+        uavs = list(self.uavs.values())
+
+        meta = {
+            "version": CHECKPOINT_VERSION,
+            "num_cars": self.num_cars,
+            "topology_rank": self.topology_rank,
+            "vectorized": self.vectorized,
+            "seed": self.seed,
+            "step_count": self.step_count,
+            "car_rng": self.car_rng.bit_generator.state,
+            "uav_rng": self.uav_rng.bit_generator.state,
+            "car_ids": list(self.cars.keys()),
+            "car_colors": [car.car_color for car in self.cars.values()],
+            "uav_ids": list(self.uavs.keys()),
+            "uav_colors": [uav.uav_color for uav in uavs],
+        }
+
+        store = self.car_store
+        car_contacts = lists_to_csr([car.cars_in_contact for car in self.cars.values()])
+        uav_car_contacts = lists_to_csr([uav.cars_in_contact for uav in uavs])
+        uav_contacts = lists_to_csr([uav.uavs_in_contact for uav in uavs])
+
+        with open(filename, "wb") as f:
+            np.savez_compressed(f, meta=np.array(json.dumps(meta)),
+                car_segment=store.segment, car_segment_loc=store.segment_loc, car_segment_len=store.segment_len,
+                car_velocity=store.velocity, car_coord=store.coord, car_segment_end_coord=store.segment_end_coord,
+                car_direction_positive=store.direction_positive, car_direction_horizontal=store.direction_horizontal,
+                car_reached_segment_end=store.reached_segment_end,
+                car_contacts_indptr=car_contacts[0], car_contacts_indices=car_contacts[1],
+                uav_coord=np.array([uav.coord for uav in uavs], dtype=np.float64).reshape(-1, 2),
+                uav_origin_coord=np.array([uav._origin_coord for uav in uavs], dtype=np.float64).reshape(-1, 2),
+                uav_state_reposition=np.array([uav.state_reposition for uav in uavs], dtype=bool),
+                uav_radius=np.array([uav.radius_of_operation for uav in uavs], dtype=np.float64),
+                uav_displacement_range=np.array([uav.random_displacement_range for uav in uavs], dtype=np.float64).reshape(-1, 2),
+                uav_car_contacts_indptr=uav_car_contacts[0], uav_car_contacts_indices=uav_car_contacts[1],
+                uav_contacts_indptr=uav_contacts[0], uav_contacts_indices=uav_contacts[1])
+
+    @classmethod
+    def from_checkpoint(cls, filename: str, headless: bool = True, seed: int = None):
+        # City in the state save_checkpoint wrote, without the random
+        # placement of __init__. Passing a seed forks the run: the state is
+        # kept but the random streams are fresh ones from that seed.
+        with np.load(filename, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in data.files}
+
+        meta = json.loads(str(arrays.pop("meta")))
+
+        if meta["version"] != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {meta['version']} in {filename}")
+
+        city = cls.__new__(cls)
+        city._init_world(meta["num_cars"], meta["topology_rank"], meta["vectorized"], headless, meta["seed"] if seed is None else seed)
+
+        if seed is None:
+            city.car_rng.bit_generator.state = meta["car_rng"]
+            city.uav_rng.bit_generator.state = meta["uav_rng"]
+
+        store = city.car_store
+        store.segment_loc[:] = arrays["car_segment_loc"]
+        store.segment_len[:] = arrays["car_segment_len"]
+        store.velocity[:] = arrays["car_velocity"]
+        store.coord[:] = arrays["car_coord"]
+        store.segment_end_coord[:] = arrays["car_segment_end_coord"]
+        store.direction_positive[:] = arrays["car_direction_positive"]
+        store.direction_horizontal[:] = arrays["car_direction_horizontal"]
+        store.reached_segment_end[:] = arrays["car_reached_segment_end"]
+        store.set_segment(np.arange(store.num_cars), arrays["car_segment"])
+        store.touch()
+
+        car_contacts = csr_to_lists(arrays["car_contacts_indptr"], arrays["car_contacts_indices"])
+
+        for i, (car_id, car_color) in enumerate(zip(meta["car_ids"], meta["car_colors"])):
+            city.cars[car_id] = Car.view(city, car_id, car_color)
+            city.cars[car_id].update_contacts(car_contacts[i])
+
+        uav_car_contacts = csr_to_lists(arrays["uav_car_contacts_indptr"], arrays["uav_car_contacts_indices"])
+        uav_contacts = csr_to_lists(arrays["uav_contacts_indptr"], arrays["uav_contacts_indices"])
+
+        for i, (uav_id, uav_color) in enumerate(zip(meta["uav_ids"], meta["uav_colors"])):
+            uav = UAV(city, uav_id, tuple(arrays["uav_origin_coord"][i].tolist()), float(arrays["uav_radius"][i]),
+                tuple(arrays["uav_displacement_range"][i].tolist()), uav_color)
+            uav.coord = arrays["uav_coord"][i].tolist()
+            uav.state_reposition = bool(arrays["uav_state_reposition"][i])
+            uav.update_contacts(uav_car_contacts[i], uav_contacts[i])
+
+            city.uavs[uav_id] = uav
+
+        city._init_runtime()
+        city.step_count = meta["step_count"]
+
+        return city
+
+    def _frame_renderer(self, writer, topo_writer, processes: int):
+        if processes <= 1:
+            return contextlib.nullcontext()
+
+        import matplotlib
+
+        return ParallelFrameRenderer(self.topology, self.figure_size, matplotlib.rcParams["figure.dpi"], writer, topo_writer, processes=processes)
 
     def plot_network_topology(self):
+        plt = self._ensure_figure()
         topology = self.current_network_topology
-        pos = nx.circular_layout(topology)
-        nx.draw(topology, pos, with_labels=True, node_size=1000, font_size=15)
-        labels = nx.get_edge_attributes(topology, 'weight')
-        nx.draw_networkx_edge_labels(topology, pos, edge_labels=labels)
-        plt.draw()
+        draw_network(plt, list(topology.nodes), list(topology.edges(data="weight")))
 
-    @property
-    def current_network_topology(self):
-        G = nx.Graph()
+    def _sync_contact_graph(self):
+        if self._contact_graph_step == self.step_count:
+            return
+
+        uav_links = set()
+        uav_car_links = set()
+        car_links = set()
 
         for uav_id, uav in self.uavs.items():
-            G.add_node(f"U{uav_id}")#, pos=uav._origin_coord)
+            uav_links.update((uav_id, other_uav_id) if uav_id < other_uav_id else (other_uav_id, uav_id) for other_uav_id in uav.uavs_in_contact)
+            uav_car_links.update((uav_id, car_id) for car_id in uav.cars_in_contact)
 
-        for car_id in self.cars.keys():
-            G.add_node(f"C{car_id}")
+        for car_id, car in self.cars.items():
+            car_links.update((car_id, other_car_id) if car_id < other_car_id else (other_car_id, car_id) for other_car_id in car.cars_in_contact)
 
-        uav_edged_ctr = list()
-        car_edged_ctr = list()
+        self.contact_graph.update({"uav": uav_links, "uav_car": uav_car_links, "car": car_links})
+        self._contact_graph_step = self.step_count
 
-        for uav_id, uav in self.uavs.items():
-            for other_uav_id in uav.uavs_in_contact:
-                if ((uav_id, other_uav_id) not in uav_edged_ctr) and ((other_uav_id, uav_id) not in uav_edged_ctr):
-                    G.add_edge(f"U{uav_id}", f"U{other_uav_id}", weight=uav.distance_to(self.uavs[other_uav_id].coord)*SEGMENT_LENS/2)
-                    uav_edged_ctr.append((uav_id, other_uav_id))
+    def _contact_weights(self, kind: str, links):
+        uav_index = {uav_id: i for i, uav_id in enumerate(self.uavs.keys())}
+        uav_coords = np.array([uav.coord for uav in self.uavs.values()], dtype=np.float64).reshape(-1, 2)
 
-            for car_id in uav.cars_in_contact:
-                G.add_edge(f"U{uav_id}", f"C{car_id}", weight=uav.distance_to(self.cars[car_id].car_coord)*SEGMENT_LENS/2)
+        if kind == "car":
+            real_coords = self.car_store.real_coord
+            c0 = real_coords[links[:, 0]]
+            c1 = real_coords[links[:, 1]]
 
-        for car_id, car in self.cars.items():
-            for other_car_id in car.cars_in_contact:
-                if ((car_id, other_car_id) not in car_edged_ctr) and ((other_car_id, car_id) not in car_edged_ctr):
-                    G.add_edge(f"C{car_id}", f"C{other_car_id}", weight=car.real_distance_to(self.cars[other_car_id]))
-                    car_edged_ctr.append((car_id, other_car_id))
+            return scalar_distances(c0[:, 0] - c1[:, 0], c0[:, 1] - c1[:, 1])
+
+        c0 = uav_coords[[uav_index[i] for i in links[:, 0].tolist()]].reshape(-1, 2)
+
+        if kind == "uav":
+            c1 = uav_coords[[uav_index[i] for i in links[:, 1].tolist()]].reshape(-1, 2)
+        else:
+            c1 = self.car_store.coord[links[:, 1]]
 
-        return G
+        return scalar_distances(c0[:, 0] - c1[:, 0], c0[:, 1] - c1[:, 1]) * SEGMENT_LENS / 2
+
+    @property
+    def current_network_topology(self):
+        # Live graph kept in sync with the contact lists; it is patched in
+        # place every step, so copy() it to keep one step's network
+        self._sync_contact_graph()
+        return self.contact_graph.to_networkx(self._contact_weights)
+
+    def connectivity(self):
+        # Components, UAV coverage and hops to the nearest UAV of the contact
+        # network, on integer node indices in contact_graph.node_labels order.
+        # Computed once per step; see connectivity.contact_connectivity.
+        if self._connectivity_step != self.step_count:
+            self._sync_contact_graph()
+            self._connectivity = contact_connectivity(len(self.uavs), len(self.cars), *self.contact_graph.edge_arrays())
+            self._connectivity_step = self.step_count
+
+        return self._connectivity
+
+    def contact_indexes(self):
+        # (cars, uavs) ContactIndex over the car and UAV contact lists and the
+        # cars' real coordinates, built once per step. Car contacts sit on the
+        # car's own road line, so their blocks are sorted along it.
+        if self._contact_indexes_step != self.step_count:
+            store = self.car_store
+            real_coord = store.real_coord
+
+            cars = ContactIndex(*lists_to_csr([car.cars_in_contact for car in self.cars.values()]), real_coord,
+                axes=np.where(store.direction_horizontal, 0, 1), segments=self.topology.segment_undirected[store.segment])
+            uavs = ContactIndex(*lists_to_csr([uav.cars_in_contact for uav in self.uavs.values()]), real_coord)
+
+            self._contact_indexes = (cars, uavs)
+            self._contact_indexes_step = self.step_count
+
+        return self._contact_indexes
+
+    def joint_real_coords(self, joint_ids):
+        return self.topology.node_coords[np.asarray(joint_ids, dtype=np.int64)] * SEGMENT_LENS / 2
+
+    def nearest_contacts(self, car_ids, points):
+        # Contact of each car nearest to each (real coordinate) point, as
+        # (car ids, distances) with -1 and inf where a car has no contacts
+        return self.contact_indexes()[0].nearest(car_ids, points)
+
+    def nearest_contacts_on_segments(self, car_ids, points, segment_ids):
+        # Same, among contacts on the segments (either direction)
+        return self.contact_indexes()[0].nearest_on_segments(car_ids, points, self.topology.segment_undirected[np.asarray(segment_ids, dtype=np.int64)])
+
+    def farthest_contacts_on_segments(self, car_ids, points, segment_ids):
+        # Contact on the segments farthest from each point, -1 and 0 if none
+        return self.contact_indexes()[0].farthest_on_segments(car_ids, points, self.topology.segment_undirected[np.asarray(segment_ids, dtype=np.int64)])
+
+    def nearest_uav_contacts(self, uav_ids, points):
+        # Car in contact with each UAV nearest to each point
+        return self.contact_indexes()[1].nearest(uav_ids, points)
+
+    def nearest_uavs_via(self, car_ids, joint_ids):
+        # UAV with the shortest car -> UAV -> joint path for every (car,
+        # joint), in car real units; the first of equally short ones wins
+        store = self.car_store
+        car_ids = np.asarray(car_ids, dtype=np.int64)
+        num_queries = len(car_ids)
+
+        uav_ids = np.fromiter(self.uavs.keys(), dtype=np.int64, count=len(self.uavs))
+        uav_coords = np.array([uav.coord for uav in self.uavs.values()], dtype=np.float64).reshape(-1, 2)
+
+        ids = np.full(num_queries, -1, dtype=np.int64)
+        dists = np.full(num_queries, np.inf)
+
+        if num_queries == 0 or len(uav_ids) == 0:
+            return ids, dists
+
+        uav_real = uav_coords[None, :, :] * store.segment_len[car_ids, None, None] / 2
+        to_car = uav_real - store.real_coord[car_ids, None, :]
+        to_joint = uav_real - self.joint_real_coords(joint_ids)[:, None, :]
+
+        approx = ((to_car**2).sum(axis=2))**.5 + ((to_joint**2).sum(axis=2))**.5
+        queries, slots = np.nonzero(approx <= approx.min(axis=1, keepdims=True) * (1 + TIE_MARGIN))
+
+        exact = scalar_distances(to_car[queries, slots, 0], to_car[queries, slots, 1]) + scalar_distances(to_joint[queries, slots, 0], to_joint[queries, slots, 1])
+        order = np.lexsort((slots, exact, queries))
+        queries = queries[order]
+        first = np.concatenate([[True], queries[1:] != queries[:-1]])
+
+        ids[queries[first]] = uav_ids[slots[order][first]]
+        dists[queries[first]] = exact[order][first]
+
+        return ids, dists
+
+    def network_csr(self, weighted: bool = True):
+        # (indptr, indices, weights) of the contact network over
+        # contact_graph.node_labels, UAVs first then cars
+        self._sync_contact_graph()
+        return self.contact_graph.to_csr(self._contact_weights if weighted else None)
 
 class UAV(object):
     def __init__(self, city: City, uav_id: int, coord: tuple, radius_of_operation: float, random_displacement_range: tuple, uav_color: str):
@@ -453,7 +1099,15 @@ class UAV(object):
         self.cars_in_contact = cars
         self.uavs_in_contact = uavs
 
-    def simulation_step(self):
+    def simulation_step(self, roll: float = None, angle: int = None, disp: float = None):
+        # roll, angle (degrees) and disp are drawn by the city in one batch
+        # per step; missing ones are drawn here from the city's UAV stream
+        if roll is None:
+            rng = self._city.uav_rng
+            roll = rng.integers(0, 101) / 100
+            angle = int(rng.integers(0, 361))
+            disp = rng.integers(int(self.random_displacement_range[0] * 1000), int(self.random_displacement_range[1] * 1000) + 1) / 1000
+
         if self.state_reposition or (self.distance_to(self._origin_coord) >= UAV_REPOSITION_THRESH):
             self.state_reposition = True
 
@@ -470,103 +1124,133 @@ class UAV(object):
             if self.distance_to(self._origin_coord) < UAV_REPOSITION_THRESH:
                 self.state_reposition = False
         else:
-            if (random.randint(0, 100) / 100) >= UAV_DISP_RANDOMNESS:
-                random_angle = random.randint(0, 360)
-                random_angle *= (math.pi / 180)
-                random_disp = random.randint(int(self.random_displacement_range[0] * 1000), int(self.random_displacement_range[1] * 1000)) / 1000
+            if roll >= UAV_DISP_RANDOMNESS:
+                random_angle = angle * (math.pi / 180)
 
-                self.coord[0] += math.cos(random_angle) * random_disp
-                self.coord[1] += math.sin(random_angle) * random_disp
+                self.coord[0] += math.cos(random_angle) * disp
+                self.coord[1] += math.sin(random_angle) * disp
 
     def distance_to(self, coord: tuple):
         return ((self.coord[0] - coord[0])**2 + (self.coord[1] - coord[1])**2)**.5
 
     def nearest_car_in_section_near_intersection(self, section: tuple, intersection_id: int):
-        min_dist = float("inf")
-        min_dist_car_id = None
-
-        intersection_real_coord = self._city._real_coord_of_joint(intersection_id)
-
-        for car_id in self.cars_in_contact:
-            car = self._city.cars[car_id]
-            dist = square_distance(intersection_real_coord[0], intersection_real_coord[1], car.real_coord[0], car.real_coord[1])
-
-            if dist < min_dist:
-                min_dist = dist
-                min_dist_car_id = car_id
-
-        return (min_dist_car_id, min_dist)
+        return _query_result(*self._city.contact_indexes()[1].nearest_one(self.uav_id, self._city._real_coord_of_joint(intersection_id)))
 
 class Car(object):
+    # Thin view over row `car_id` of the city's CarStore
     def __init__(self, city: City, car_id: int, segment: tuple, segment_loc: int, segment_len: int, car_velocity: int, car_color: str, car_coord: tuple, car_direction_positive: bool, car_direction_horizontal: bool, segment_end_coord: tuple):
         self._city = city
+        self._store = city.car_store
         self.car_id = car_id
-        self.segment = segment
-        self.segment_loc = segment_loc
-        self.segment_len = segment_len
-        self.car_velocity = car_velocity
         self.car_color = car_color
-        self.car_coord = car_coord
-        self.car_direction_positive = car_direction_positive
-        self.car_direction_horizontal = car_direction_horizontal
-        self.segment_end_coord = segment_end_coord
+        self.car_velocity = car_velocity
 
-        self.real_coord = [self.car_coord[0] * self.segment_len / 2, self.car_coord[1] * self.segment_len / 2]
+        self.update(segment, segment_loc, segment_len, car_direction_positive, car_direction_horizontal, car_coord, segment_end_coord)
 
-        self.reached_segment_end = False
+        self.cars_in_contact = list()
 
-        if segment_loc >= segment_len:
-            self.reached_segment_end = True
+    @classmethod
+    def view(cls, city: City, car_id: int, car_color: str):
+        # View over a CarStore row that is already filled in
+        car = cls.__new__(cls)
+        car._city = city
+        car._store = city.car_store
+        car.car_id = car_id
+        car.car_color = car_color
+        car.cars_in_contact = list()
 
-        self.cars_in_contact = list()
+        return car
 
-    def closest_neighbor_car_to_point2(self, coord: tuple):
-        min_distance = float("inf")
-        min_dist_car_id = None
+    @property
+    def segment(self):
+        return self._store.segment_of(self.car_id)
 
-        for car_id in self.cars_in_contact:
-            car = self._city.cars[car_id]
-            dist = square_distance(coord[0], coord[1], car.real_coord[0], car.real_coord[1])
+    @segment.setter
+    def segment(self, segment: tuple):
+        self._store.set_segment(self.car_id, self._city.topology.segment_ids[segment])
 
-            if dist < min_distance:
-                min_distance = dist
-                min_dist_car_id = car_id
+    @property
+    def segment_loc(self):
+        return float(self._store.segment_loc[self.car_id])
 
-        return (min_dist_car_id, min_distance)
+    @segment_loc.setter
+    def segment_loc(self, segment_loc):
+        self._store.segment_loc[self.car_id] = segment_loc
 
-    def closest_neighbor_car_to_intersection_point(self, joint_id: int):
-        joint_coord = self._city._real_coord_of_joint(joint_id)
+    @property
+    def segment_len(self):
+        return float(self._store.segment_len[self.car_id])
 
-        min_distance = float("inf")
-        min_dist_car_id = None
+    @segment_len.setter
+    def segment_len(self, segment_len):
+        self._store.segment_len[self.car_id] = segment_len
+        self._store.touch([self.car_id])
 
-        for car_id in self.cars_in_contact:
-            car = self._city.cars[car_id]
-            dist = square_distance(joint_coord[0], joint_coord[1], car.real_coord[0], car.real_coord[1])
+    @property
+    def car_velocity(self):
+        return float(self._store.velocity[self.car_id])
 
-            if dist < min_distance:
-                min_distance = dist
-                min_dist_car_id = car_id
+    @car_velocity.setter
+    def car_velocity(self, car_velocity):
+        self._store.velocity[self.car_id] = car_velocity
 
-        return (min_dist_car_id, min_distance)
+    @property
+    def car_coord(self):
+        # Writable row of the store, in-place updates go through
+        return self._store.coord[self.car_id]
 
-    def closest_neighbor_car_to_intersection_point_in_segment(self, joint_id: int, segment: tuple):
-        joint_coord = self._city._real_coord_of_joint(joint_id)
+    @car_coord.setter
+    def car_coord(self, car_coord):
+        self._store.coord[self.car_id] = car_coord
+        self._store.touch([self.car_id])
+
+    @property
+    def segment_end_coord(self):
+        return self._store.segment_end_coord[self.car_id]
+
+    @segment_end_coord.setter
+    def segment_end_coord(self, segment_end_coord):
+        self._store.segment_end_coord[self.car_id] = segment_end_coord
 
-        min_distance = float("inf")
-        min_dist_car_id = None
+    @property
+    def car_direction_positive(self):
+        return bool(self._store.direction_positive[self.car_id])
+
+    @car_direction_positive.setter
+    def car_direction_positive(self, car_direction_positive):
+        self._store.direction_positive[self.car_id] = car_direction_positive
+
+    @property
+    def car_direction_horizontal(self):
+        return bool(self._store.direction_horizontal[self.car_id])
+
+    @car_direction_horizontal.setter
+    def car_direction_horizontal(self, car_direction_horizontal):
+        self._store.direction_horizontal[self.car_id] = car_direction_horizontal
+
+    @property
+    def reached_segment_end(self):
+        return bool(self._store.reached_segment_end[self.car_id])
+
+    @reached_segment_end.setter
+    def reached_segment_end(self, reached_segment_end):
+        self._store.reached_segment_end[self.car_id] = reached_segment_end
+
+    @property
+    def real_coord(self):
+        coord = self._store.coord[self.car_id]
+        segment_len = self._store.segment_len[self.car_id]
 
-        for car_id in self.cars_in_contact:
-            car = self._city.cars[car_id]
+        return [float(coord[0] * segment_len / 2), float(coord[1] * segment_len / 2)]
 
-            if (car.segment == segment) or (car.segment == (segment[1], segment[0])):
-                dist = square_distance(joint_coord[0], joint_coord[1], car.real_coord[0], car.real_coord[1])
+    def closest_neighbor_car_to_point2(self, coord: tuple):
+        return _query_result(*self._city.contact_indexes()[0].nearest_one(self.car_id, coord))
 
-                if dist < min_distance:
-                    min_distance = dist
-                    min_dist_car_id = car_id
+    def closest_neighbor_car_to_intersection_point(self, joint_id: int):
+        return _query_result(*self._city.contact_indexes()[0].nearest_one(self.car_id, self._city._real_coord_of_joint(joint_id)))
 
-        return (min_dist_car_id, min_distance)
+    def closest_neighbor_car_to_intersection_point_in_segment(self, joint_id: int, segment: tuple):
+        return _query_result(*self._city.contact_indexes()[0].nearest_one_on_segment(self.car_id, self._city._real_coord_of_joint(joint_id), self._city._undirected_segment_id(segment)))
 
     def my_section_joint_near_joint(self, j):
         if square_distance(self._city._real_coord_of_joint(j)[0], self._city._real_coord_of_joint(j)[1], self._city._real_coord_of_joint(self.segment[0])[0], self._city._real_coord_of_joint(self.segment[0])[1]) < square_distance(self._city._real_coord_of_joint(j)[0], self._city._real_coord_of_joint(j)[1], self._city._real_coord_of_joint(self.segment[1])[0], self._city._real_coord_of_joint(self.segment[1])[1]):
@@ -589,38 +1273,11 @@ class Car(object):
         return False
 
     def farthest_neighbor_car_to_intersection_point_in_segment(self, joint_id: int, segment: tuple):
-        joint_coord = self._city._real_coord_of_joint(joint_id)
-
-        max_distance = 0
-        dist_car_id = None
-
-        for car_id in self.cars_in_contact:
-            car = self._city.cars[car_id]
-
-            if (car.segment == segment) or (car.segment == (segment[1], segment[0])):
-                dist = square_distance(joint_coord[0], joint_coord[1], car.real_coord[0], car.real_coord[1])
-
-                if dist >= max_distance:
-                    max_distance = dist
-                    dist_car_id = car_id
-
-        return (dist_car_id, max_distance)
+        return _query_result(*self._city.contact_indexes()[0].farthest_one_on_segment(self.car_id, self._city._real_coord_of_joint(joint_id), self._city._undirected_segment_id(segment)), 0)
 
     def farthest_neighbor_car_near_intersection_point(self, joint_id):
-        joint_coord = self._city._real_coord_of_joint(joint_id)
-
-        max_distance = float("inf")
-        dist_car_id = None
-
-        for car_id in self.cars_in_contact:
-            car = self._city.cars[car_id]
-            dist = square_distance(joint_coord[0], joint_coord[1], car.real_coord[0], car.real_coord[1])
-
-            if dist < max_distance:
-                max_distance = dist
-                dist_car_id = car_id
-
-        return (dist_car_id, max_distance)
+        # Despite the name, the nearest contact to the joint
+        return self.closest_neighbor_car_to_intersection_point(joint_id)
 
     @property
     def near_intersection_point(self):
@@ -657,59 +1314,23 @@ class Car(object):
         #next_possible_segments = [s for s in self._city.topology.neighbor_segments_to(_seg) if s not in [self.segment, (self.segment[1], self.segment[0])]]
         #score_gs = [{"score": self._city.score_g(seg, target_section), "next_I": seg[1]} for seg in next_possible_segments]
 
-        _seg = self.segment
-        next_possible_segments = [s for s in self._city.topology.neighbor_segments_to(_seg)]# if s not in [self.segment, (self.segment[1], self.segment[0])]]
-        _seg = (self.segment[1], self.segment[0])
-        next_possible_segments += [s for s in self._city.topology.neighbor_segments_to(_seg)]# if s not in [self.segment, (self.segment[1], self.segment[0])]]
-        score_gs = [{"score": self._city.score_g(seg, target_section), "next_I": seg[1]} for seg in next_possible_segments]
-
-        best_one = sorted(score_gs, key=lambda x: x["score"], reverse=True)[0]      
-
-        if len(best_one) == 0 or best_one["score"] == 0:
-            return None
-
-        return best_one["next_I"] 
+        # Segments leaving either end of the car's segment, scored with
+        # score_g; see City.next_intersections_to_targets
+        return self._city.next_intersections_to_targets([self.car_id], [target_section])[0]
 
     def next_intersection_to_target_car(self, car_id: int):
         return self.next_intersection_to_target_segment(self._city.cars[car_id].segment)
 
     def nearest_neighbor_in_segment(self, segment):
-        min_distance = float("inf")
-        min_dist_car_id = None
-
-        for car_id in self.cars_in_contact:
-            car = self._city.cars[car_id]
-
-            if (car.segment == segment) or (car.segment == (segment[1], segment[0])):
-                dist = square_distance(self.real_coord[0], self.real_coord[1], car.real_coord[0], car.real_coord[1])
-
-                if dist < min_distance:
-                    min_distance = dist
-                    min_dist_car_id = car_id
-
-        return (min_dist_car_id, min_distance)
+        return _query_result(*self._city.contact_indexes()[0].nearest_one_on_segment(self.car_id, self.real_coord, self._city._undirected_segment_id(segment)))
 
     def nearest_uav_near_intersection(self, intersection_id: int):
-        min_distance = float("inf")
-        min_dist_uav_id = None
-
-        for uav_id, uav in self._city.uavs.items():
-            uav_real_coord_x = uav.coord[0] * self.segment_len / 2
-            uav_real_coord_y = uav.coord[1] * self.segment_len / 2
-
-            intersection_real_coord = self._city._real_coord_of_joint(intersection_id)
-
-            dist = square_distance(uav_real_coord_x, uav_real_coord_y, self.real_coord[0], self.real_coord[1]) + square_distance(uav_real_coord_x, uav_real_coord_y, intersection_real_coord[0], intersection_real_coord[1])
-
-            if dist < min_distance:
-                min_distance = dist
-                min_dist_uav_id = uav_id
-
-        return (min_dist_uav_id, min_distance)
+        uav_ids, dists = self._city.nearest_uavs_via([self.car_id], [intersection_id])
+        return _query_result(int(uav_ids[0]), float(dists[0]))
 
     @property
     def plot_coord(self):
-        car_coord = self.car_coord[:]
+        car_coord = self.car_coord.tolist()
 
         if self.car_direction_positive:
             _step = 0.2
@@ -738,12 +1359,7 @@ class Car(object):
         self.car_coord = new_car_coord
         self.segment_end_coord = new_segment_end_coord
 
-        self.real_coord = [self.car_coord[0] * self.segment_len / 2, self.car_coord[1] * self.segment_len / 2]
-
-        self.reached_segment_end = False
-
-        if self.segment_loc >= self.segment_len:
-            self.reached_segment_end = True
+        self.reached_segment_end = self.segment_loc >= self.segment_len
 
     def simulation_step(self):
         if not self.reached_segment_end:
@@ -752,7 +1368,6 @@ class Car(object):
             if self.segment_loc >= self.segment_len:
                 self.reached_segment_end = True
                 self.car_coord = self.segment_end_coord
-                self.real_coord = [self.car_coord[0] * self.segment_len / 2, self.car_coord[1] * self.segment_len / 2]
             else:
                 if self.car_direction_positive:
                     _step = 2 * self.car_velocity / self.segment_len
@@ -764,4 +1379,4 @@ class Car(object):
                 else:
                     self.car_coord[1] += _step
 
-                self.real_coord = [self.car_coord[0] * self.segment_len / 2, self.car_coord[1] * self.segment_len / 2]
\ No newline at end of file
+                self._store.touch([self.car_id])
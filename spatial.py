@@ -0,0 +1,125 @@
+import math
+import numpy as np
+
+_KEY_STRIDE = 1 << 32
+
+# NumPy squares and square roots are correctly rounded; Python floats go
+# through libm pow, which can be one unit in the last place off. Vectorized
+# values this close to a threshold are redone the scalar way.
+_ROUNDING_MARGIN = 1e-12
+
+def scalar_pow(x, exponent):
+    # Elementwise x ** exponent exactly as Python floats compute it
+    x = np.asarray(x, dtype=np.float64)
+    return np.fromiter((v ** exponent for v in x.ravel().tolist()), dtype=np.float64, count=x.size).reshape(x.shape)
+
+def scalar_distances(dx, dy):
+    # Elementwise (dx**2 + dy**2)**.5 exactly as Python floats compute it
+    return np.fromiter(((x**2 + y**2)**.5 for x, y in zip(np.asarray(dx).tolist(), np.asarray(dy).tolist())), dtype=np.float64, count=len(dx))
+
+def within_distance(dx, dy, radius: float):
+    # (dx**2 + dy**2)**.5 <= radius, agreeing with the scalar expression
+    dists = (dx**2 + dy**2)**.5
+    within = dists <= radius
+    unsure = np.flatnonzero(np.abs(dists - radius) <= _ROUNDING_MARGIN * radius)
+
+    if len(unsure) > 0:
+        within[unsure] = scalar_distances(dx[unsure], dy[unsure]) <= radius
+
+    return within
+
+# Half of the 3x3 cell neighbourhood, so each pair of cells is visited once
+_HALF_NEIGHBOURHOOD = ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1))
+
+class SpatialHashGrid(object):
+    # Uniform grid over 2D points, rebuilt once per step. Points are bucketed
+    # by cell and radius queries only look at the cells the circle touches.
+    # `tested` counts the distance checks made since the last rebuild.
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+
+        self.points = np.zeros((0, 2), dtype=np.float64)
+        self._order = np.zeros(0, dtype=np.int64)
+        self._sorted_keys = np.zeros(0, dtype=np.int64)
+        self._cells = dict()
+        self.tested = 0
+
+    def _cell_of(self, coord):
+        return (math.floor(coord[0] / self.cell_size), math.floor(coord[1] / self.cell_size))
+
+    def rebuild(self, points):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+        cells = np.floor(self.points / self.cell_size).astype(np.int64)
+        keys = cells[:, 0] * _KEY_STRIDE + cells[:, 1]
+
+        self._order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[self._order]
+        unique_keys, starts, counts = np.unique(self._sorted_keys, return_index=True, return_counts=True)
+
+        self._cells = {k: (s, s + c) for k, s, c in zip(unique_keys.tolist(), starts.tolist(), counts.tolist())}
+        self.tested = 0
+
+    def candidates(self, coord, radius: float):
+        cx, cy = self._cell_of(coord)
+        reach = int(math.ceil(radius / self.cell_size))
+        chunks = []
+
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                bounds = self._cells.get(i * _KEY_STRIDE + j)
+
+                if bounds is not None:
+                    chunks.append(self._order[bounds[0]:bounds[1]])
+
+        if len(chunks) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(chunks)
+
+    def query_radius(self, coord, radius: float):
+        # Indices of the points within `radius` of `coord`, in ascending order
+        idx = self.candidates(coord, radius)
+        self.tested += len(idx)
+        pts = self.points[idx]
+
+        return np.sort(idx[within_distance(coord[0] - pts[:, 0], coord[1] - pts[:, 1], radius)])
+
+    def pairs_within(self, radius: float):
+        # All pairs (i, j), i < j, of points within `radius` of each other.
+        # Needs radius <= cell_size so that every such pair sits in the same
+        # or in adjacent cells.
+        if radius > self.cell_size:
+            raise ValueError(f"radius {radius} is larger than the cell size {self.cell_size}")
+
+        num_points = len(self._sorted_keys)
+        firsts, seconds = list(), list()
+
+        for dx, dy in _HALF_NEIGHBOURHOOD:
+            target = self._sorted_keys + (dx * _KEY_STRIDE + dy)
+            lo = np.searchsorted(self._sorted_keys, target, side="left")
+            hi = np.searchsorted(self._sorted_keys, target, side="right")
+
+            if dx == 0 and dy == 0:
+                # Same cell: only the points after this one
+                lo = np.arange(1, num_points + 1)
+
+            counts = np.maximum(hi - lo, 0)
+            a = np.repeat(np.arange(num_points), counts)
+            b = lo[a] + np.arange(len(a)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+            firsts.append(a)
+            seconds.append(b)
+
+        i = self._order[np.concatenate(firsts)]
+        j = self._order[np.concatenate(seconds)]
+        self.tested += len(i)
+
+        pi, pj = self.points[i], self.points[j]
+        close = within_distance(pi[:, 0] - pj[:, 0], pi[:, 1] - pj[:, 1], radius)
+
+        i, j = i[close], j[close]
+        swap = i > j
+
+        return np.where(swap, j, i), np.where(swap, i, j)
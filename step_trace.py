@@ -0,0 +1,169 @@
+import os
+import json
+import numpy as np
+
+TRACE_CHUNK_STEPS = 100
+TRACE_META_FILE = "meta.json"
+
+def lists_to_csr(lists: list):
+    # [[ids of row 0], [ids of row 1], ...] -> (indptr, indices)
+    indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(l) for l in lists])
+    indices = np.fromiter((i for l in lists for i in l), dtype=np.int64, count=indptr[-1])
+
+    return indptr, indices
+
+def csr_to_lists(indptr, indices):
+    indices = np.asarray(indices).tolist()
+    indptr = np.asarray(indptr).tolist()
+
+    return [indices[indptr[i]:indptr[i + 1]] for i in range(len(indptr) - 1)]
+
+class TraceWriter(object):
+    # Append-only columnar trace of a run. Steps are buffered in memory and
+    # flushed every chunk_steps steps into a chunk directory holding one .npy
+    # file per field, so a run never holds more than one chunk.
+    #
+    # Fields are either fixed shape arrays, stacked per chunk as
+    # (steps, ...), or CSR pairs (indptr, indices), stored as per-step
+    # indptr rows over one concatenated indices array.
+
+    def __init__(self, directory: str, meta: dict = None, chunk_steps: int = TRACE_CHUNK_STEPS):
+        self.directory = directory
+        self.chunk_steps = chunk_steps
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.meta = {"chunk_steps": chunk_steps, "chunks": list(), "meta": meta if meta is not None else dict()}
+        self._buffer = list()
+        self._write_meta()
+
+    def _write_meta(self):
+        tmp_path = os.path.join(self.directory, TRACE_META_FILE + ".tmp")
+
+        with open(tmp_path, "w") as fp:
+            json.dump(self.meta, fp)
+
+        os.replace(tmp_path, os.path.join(self.directory, TRACE_META_FILE))
+
+    def append(self, step: int, fields: dict):
+        self._buffer.append((step, fields))
+
+        if len(self._buffer) >= self.chunk_steps:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer) == 0:
+            return
+
+        chunk_name = f"chunk_{len(self.meta['chunks']):06d}"
+        chunk_dir = os.path.join(self.directory, chunk_name)
+        os.makedirs(chunk_dir, exist_ok=True)
+
+        steps = [step for step, _ in self._buffer]
+        np.save(os.path.join(chunk_dir, "step.npy"), np.array(steps, dtype=np.int64))
+
+        fixed_fields = list()
+        csr_fields = list()
+
+        for name, value in self._buffer[0][1].items():
+            if isinstance(value, tuple):
+                indptrs = list()
+                offset = 0
+
+                for _, fields in self._buffer:
+                    indptr, _ = fields[name]
+                    indptrs.append(np.asarray(indptr, dtype=np.int64) + offset)
+                    offset += int(indptr[-1])
+
+                np.save(os.path.join(chunk_dir, f"{name}.indptr.npy"), np.stack(indptrs))
+                np.save(os.path.join(chunk_dir, f"{name}.indices.npy"), np.concatenate([np.asarray(fields[name][1]) for _, fields in self._buffer]))
+                csr_fields.append(name)
+            else:
+                np.save(os.path.join(chunk_dir, f"{name}.npy"), np.stack([np.asarray(fields[name]) for _, fields in self._buffer]))
+                fixed_fields.append(name)
+
+        self.meta["chunks"].append({"name": chunk_name, "first_step": steps[0], "last_step": steps[-1], "steps": len(steps)})
+        self.meta["fields"] = fixed_fields
+        self.meta["csr_fields"] = csr_fields
+        self._write_meta()
+
+        self._buffer = list()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class TraceReader(object):
+    # Lazy reader for a TraceWriter directory. Chunks are memory mapped on
+    # first access and reader[step] only touches the rows of that step.
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+        with open(os.path.join(directory, TRACE_META_FILE)) as fp:
+            self.meta = json.load(fp)
+
+        self.fields = self.meta.get("fields", list())
+        self.csr_fields = self.meta.get("csr_fields", list())
+        self._chunks = dict()
+
+        self._step_index = dict()
+
+        for chunk_index, chunk in enumerate(self.meta["chunks"]):
+            steps = np.load(os.path.join(directory, chunk["name"], "step.npy"))
+
+            for row, step in enumerate(steps.tolist()):
+                self._step_index[step] = (chunk_index, row)
+
+    @property
+    def steps(self):
+        return sorted(self._step_index.keys())
+
+    def __len__(self):
+        return len(self._step_index)
+
+    def __contains__(self, step: int):
+        return step in self._step_index
+
+    def _chunk(self, chunk_index: int):
+        arrays = self._chunks.get(chunk_index)
+
+        if arrays is None:
+            chunk_dir = os.path.join(self.directory, self.meta["chunks"][chunk_index]["name"])
+            arrays = dict()
+
+            for name in self.fields:
+                arrays[name] = np.load(os.path.join(chunk_dir, f"{name}.npy"), mmap_mode="r")
+
+            for name in self.csr_fields:
+                arrays[name] = (np.load(os.path.join(chunk_dir, f"{name}.indptr.npy"), mmap_mode="r"), np.load(os.path.join(chunk_dir, f"{name}.indices.npy"), mmap_mode="r"))
+
+            self._chunks[chunk_index] = arrays
+
+        return arrays
+
+    def __getitem__(self, step: int):
+        chunk_index, row = self._step_index[step]
+        arrays = self._chunk(chunk_index)
+        ret = {"step": step}
+
+        for name in self.fields:
+            ret[name] = arrays[name][row]
+
+        for name in self.csr_fields:
+            indptr, indices = arrays[name]
+            row_indptr = np.asarray(indptr[row])
+
+            ret[name] = (row_indptr - row_indptr[0], indices[row_indptr[0]:row_indptr[-1]])
+
+        return ret
+
+    def field(self, name: str):
+        # Whole run of one fixed shape field, as (steps, ...)
+        return np.concatenate([self._chunk(i)[name] for i in range(len(self.meta["chunks"]))])
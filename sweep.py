@@ -0,0 +1,125 @@
+import os
+import sys
+import csv
+import json
+import itertools
+import multiprocessing
+import numpy as np
+
+import simulation
+
+# Grid keys that are City arguments or run settings; any other key must be
+# one of the model constants of simulation.py below
+RUN_PARAMS = ("num_cars", "topology_rank", "seed", "steps")
+RUN_DEFAULTS = {"seed": 0, "steps": 100}
+
+METRIC_COLUMNS = ("car_links", "uav_car_links", "uav_links",
+    "components", "largest_component_frac", "uav_coverage_frac",
+    "connectedness", "sparse_segments", "anvpa", "stdds")
+
+SWEEP_CONSTANTS = ("UAV_RADIUS", "UAV_DISP_RANGE", "UAV_REPOSITION_THRESH", "UAV_REPOSITION_STEP", "UAV_DISP_RANDOMNESS",
+    "CAR_CONTACT_SEGMENT_RANGE", "CAR_CONTACT_RANGE_AS_ROAD_UNITS", "ROAD_SLICING_RANGE", "SEGMENT_LENS",
+    "CAR_NEAR_INTERSECTION_THRESH", "SPARSE_INTERVAL_RECT_HEIGHT_WIDTH")
+
+_DEFAULT_CONSTANTS = {name: getattr(simulation, name) for name in SWEEP_CONSTANTS}
+
+def expand_grid(grid: dict):
+    # Cartesian product of a {name: [values]} grid, in a stable order
+    for name in grid:
+        if name not in RUN_PARAMS and name not in _DEFAULT_CONSTANTS:
+            raise ValueError(f"Unknown sweep parameter {name}")
+
+    for name in ("num_cars", "topology_rank"):
+        if name not in grid:
+            raise ValueError(f"Sweep grid needs {name}")
+
+    names = sorted(grid)
+
+    for values in itertools.product(*(grid[name] for name in names)):
+        params = dict(RUN_DEFAULTS)
+        params.update(zip(names, values))
+        yield params
+
+def run_key(params: dict):
+    return json.dumps(params, sort_keys=True)
+
+def _step_metrics(city: simulation.City):
+    links = city.contact_graph.links
+    connectivity = city.connectivity()
+    metrics = city.step_segment_metrics()
+
+    return (len(links["car"]), len(links["uav_car"]), len(links["uav"]),
+        connectivity["num_components"], connectivity["largest_component"] / (len(city.uavs) + len(city.cars)), connectivity["uav_coverage"],
+        float(np.mean(np.log1p(metrics["connectedness"]))), float(np.mean(metrics["connectedness"] == 0)),
+        float(np.mean(metrics["anvpa"])), float(np.mean(metrics["stdds"])))
+
+def run_one(params: dict):
+    # Runs one configuration headless and returns its row of aggregate
+    # metrics, averaged over steps. Connectedness is averaged as log1p since
+    # it is a product over car gaps.
+    for name, value in _DEFAULT_CONSTANTS.items():
+        setattr(simulation, name, params.get(name, value))
+
+    city = simulation.City(params["num_cars"], params["topology_rank"], headless=True, seed=params["seed"])
+    totals = np.zeros(len(METRIC_COLUMNS), dtype=np.float64)
+
+    for _ in range(params["steps"]):
+        city.simulation_step()
+        totals += _step_metrics(city)
+
+    row = {"run": run_key(params)}
+    row.update(params)
+    row.update(zip(METRIC_COLUMNS, (totals / max(params["steps"], 1)).tolist()))
+
+    return row
+
+def completed_runs(results_filename: str):
+    if not os.path.exists(results_filename):
+        return set()
+
+    with open(results_filename, newline="") as f:
+        return set(row["run"] for row in csv.DictReader(f))
+
+def run_sweep(grid: dict, results_filename: str, processes: int = None):
+    # Runs every configuration of the grid on a process pool and appends one
+    # row per run to results_filename as runs finish. Runs already in the
+    # file are skipped, so an interrupted sweep resumes where it stopped.
+    runs = list(expand_grid(grid))
+    done = completed_runs(results_filename)
+    pending = [params for params in runs if run_key(params) not in done]
+
+    write_header = not os.path.exists(results_filename) or os.path.getsize(results_filename) == 0
+
+    if write_header:
+        columns = ["run"] + sorted(set(name for params in runs for name in params)) + list(METRIC_COLUMNS)
+    else:
+        with open(results_filename, newline="") as f:
+            columns = next(csv.reader(f))
+
+    print(f"{len(runs) - len(pending)} of {len(runs)} runs done, {len(pending)} to go")
+
+    if len(pending) == 0:
+        return
+
+    with open(results_filename, "a", newline="") as f, multiprocessing.get_context("spawn").Pool(processes) as pool:
+        writer = csv.DictWriter(f, fieldnames=columns)
+
+        if write_header:
+            writer.writeheader()
+
+        for i, row in enumerate(pool.imap_unordered(run_one, pending)):
+            writer.writerow(row)
+            f.flush()
+
+            print(f"{i + 1}/{len(pending)} {row['run']}")
+
+if __name__ == "__main__":
+    # python sweep.py grid.json results.csv [processes]
+    # grid.json: {"num_cars": [50, 100], "topology_rank": [5], "seed": [0, 1], "UAV_RADIUS": [2.15, 3]}
+    with open(sys.argv[1]) as f:
+        grid = json.load(f)
+
+    results_filename = sys.argv[2]
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    run_sweep(grid, results_filename, processes)
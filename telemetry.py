@@ -0,0 +1,228 @@
+import json
+import time
+import socket
+import threading
+import collections
+import numpy as np
+
+TELEMETRY_BUFFER = 256
+
+class _ThreadedSink(object):
+    # Records wait in a bounded buffer for a writer thread, so publish()
+    # never blocks the step loop. When the writer falls behind the oldest
+    # waiting records are dropped and counted in `dropped`.
+
+    def __init__(self, buffer: int = TELEMETRY_BUFFER):
+        self.dropped = 0
+
+        self._buffer = collections.deque(maxlen=buffer)
+        self._ready = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def publish(self, record: dict):
+        with self._ready:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+
+            self._buffer.append(record)
+            self._ready.notify()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while len(self._buffer) == 0 and not self._closed:
+                    self._ready.wait()
+
+                if len(self._buffer) == 0:
+                    return
+
+                record = self._buffer.popleft()
+
+            self._write(record)
+
+    def _write(self, record: dict):
+        raise NotImplementedError
+
+    def close(self):
+        # Writes what is still buffered, then stops the writer
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+
+        self._thread.join()
+
+class JsonlSink(_ThreadedSink):
+    # One JSON object per line, flushed after every record
+    def __init__(self, filename: str, buffer: int = TELEMETRY_BUFFER):
+        self._file = open(filename, "a")
+        super().__init__(buffer)
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        super().close()
+        self._file.close()
+
+class SocketSink(_ThreadedSink):
+    # JSON lines to a TCP (host, port) or Unix socket path listener. The
+    # connection is (re)opened on demand; records that cannot be sent are
+    # dropped rather than retried.
+    def __init__(self, address, buffer: int = TELEMETRY_BUFFER, timeout: float = 1.0):
+        self.address = address
+        self.timeout = timeout
+        self._socket = None
+        super().__init__(buffer)
+
+    def _connect(self):
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+
+        return sock
+
+    def _write(self, record: dict):
+        try:
+            if self._socket is None:
+                self._socket = self._connect()
+
+            self._socket.sendall((json.dumps(record) + "\n").encode())
+        except OSError:
+            with self._ready:
+                self.dropped += 1
+
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+
+    def close(self):
+        super().close()
+
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+class AsyncioQueueSink(object):
+    # Hands records to an asyncio.Queue owned by `loop`, from any thread. A
+    # full queue loses its oldest record to make room; records published
+    # before the loop gets to run are coalesced into a bounded backlog.
+    def __init__(self, queue, loop, buffer: int = TELEMETRY_BUFFER):
+        self.queue = queue
+        self.dropped = 0
+
+        self._loop = loop
+        self._backlog = collections.deque(maxlen=buffer)
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    def publish(self, record: dict):
+        with self._lock:
+            if len(self._backlog) == self._backlog.maxlen:
+                self.dropped += 1
+
+            self._backlog.append(record)
+
+            if self._scheduled:
+                return
+
+            self._scheduled = True
+
+        self._loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            records = list(self._backlog)
+            self._backlog.clear()
+            self._scheduled = False
+
+        for record in records:
+            if self.queue.full():
+                self.queue.get_nowait()
+
+                with self._lock:
+                    self.dropped += 1
+
+            self.queue.put_nowait(record)
+
+    def close(self):
+        pass
+
+def _summary(values):
+    values = np.asarray(values, dtype=np.float64)
+
+    if len(values) == 0:
+        return {"mean": 0.0, "max": 0.0}
+
+    return {"mean": float(values.mean()), "max": float(values.max())}
+
+class TelemetryPublisher(object):
+    # Publishes one record every `every` steps of a city to a sink, from the
+    # city's stats callbacks (attaching turns stats on until close()).
+    # Records carry the step's phase times and counters, plus connectivity
+    # and segment density summaries unless switched off, as those cost a
+    # pass each.
+
+    def __init__(self, city, sink, every: int = 1, coverage: bool = True, segments: bool = True):
+        self.city = city
+        self.sink = sink
+        self.every = every
+        self.coverage = coverage
+        self.segments = segments
+
+        # advance() can move several steps between callbacks, so records go
+        # out once `every` steps have passed since the last one
+        self._last_step = city.step_count
+        self._stats_enabled = city.stats.enabled
+
+        city.stats.enabled = True
+        city.stats.callbacks.append(self)
+
+    def __call__(self, step: int, stats):
+        if step - self._last_step < self.every:
+            return
+
+        self._last_step = step
+        self.sink.publish(self.record(step, stats))
+
+    def record(self, step: int, stats):
+        city = self.city
+        record = {
+            "step": step,
+            "time": time.time(),
+            "phase_s": dict(stats.step_times),
+            "counters": dict(stats.step_counters),
+        }
+
+        if self.coverage:
+            connectivity = city.connectivity()
+            record["connectivity"] = {
+                "components": connectivity["num_components"],
+                "largest_component": connectivity["largest_component"],
+                "uav_coverage": connectivity["uav_coverage"],
+                "uav_reachable": connectivity["uav_reachable"],
+            }
+
+        if self.segments:
+            metrics = city.step_segment_metrics()
+            record["segments"] = {
+                "disconnected": float(np.mean(metrics["connectedness"] == 0)) if len(metrics["connectedness"]) > 0 else 0.0,
+                "anvpa": _summary(metrics["anvpa"]),
+                "stdds": _summary(metrics["stdds"]),
+            }
+
+        return record
+
+    def close(self):
+        # Detaches from the city and closes the sink
+        if self in self.city.stats.callbacks:
+            self.city.stats.callbacks.remove(self)
+            self.city.stats.enabled = self._stats_enabled
+
+        self.sink.close()
@@ -0,0 +1,38 @@
+import numpy as np
+
+from simulation import City
+
+STATE = ("segment", "segment_loc", "segment_len", "velocity", "coord", "segment_end_coord",
+    "direction_positive", "direction_horizontal", "reached_segment_end")
+
+def _stores(num_cars: int, topology_rank: int, seed: int):
+    stores = list()
+
+    for _ in range(2):
+        store = City(num_cars, topology_rank, headless=True, seed=seed).car_store
+
+        # Velocities whose sums land on a segment end only in decimal, and
+        # cars that never move
+        store.velocity[::7] = 17.2
+        store.velocity[3::11] = 0.0
+        ids = np.arange(0, num_cars, 7)
+        store.place(ids, store.segment[ids], np.full(len(ids), 42.0))
+
+        stores.append(store)
+
+    return stores
+
+def test_advance_matches_step_loop():
+    stepped, advanced = _stores(200, 5, seed=3)
+
+    transitions = 0
+
+    for _ in range(2000):
+        transitions += len(stepped.step())
+
+    assert advanced.advance(2000) == transitions
+
+    for name in STATE:
+        assert np.array_equal(getattr(stepped, name), getattr(advanced, name)), name
+
+    assert stepped.rng.bit_generator.state == advanced.rng.bit_generator.state
@@ -0,0 +1,91 @@
+import pytest
+import numpy as np
+
+from simulation import City, CAR_CONTACT_RANGE_AS_ROAD_UNITS, CAR_CONTACT_SEGMENT_RANGE
+
+CAR_STATE = ("segment", "segment_loc", "segment_len", "velocity", "coord", "segment_end_coord",
+    "direction_positive", "direction_horizontal", "reached_segment_end")
+
+def _assert_same_city(a: City, b: City):
+    assert a.step_count == b.step_count
+
+    for name in CAR_STATE:
+        assert np.array_equal(getattr(a.car_store, name), getattr(b.car_store, name)), name
+
+    assert [car.cars_in_contact for car in a.cars.values()] == [car.cars_in_contact for car in b.cars.values()]
+    assert [uav.coord for uav in a.uavs.values()] == [uav.coord for uav in b.uavs.values()]
+    assert [uav.cars_in_contact for uav in a.uavs.values()] == [uav.cars_in_contact for uav in b.uavs.values()]
+    assert [uav.uavs_in_contact for uav in a.uavs.values()] == [uav.uavs_in_contact for uav in b.uavs.values()]
+
+    assert a.car_rng.bit_generator.state == b.car_rng.bit_generator.state
+    assert a.uav_rng.bit_generator.state == b.uav_rng.bit_generator.state
+
+def test_advance_matches_simulation_steps():
+    stepped = City(150, 5, headless=True, seed=7)
+    advanced = City(150, 5, headless=True, seed=7)
+
+    for span in (1, 17, 60):
+        for _ in range(span):
+            stepped.simulation_step()
+
+        advanced.advance(span)
+
+        _assert_same_city(stepped, advanced)
+
+def test_car_contacts_match_pairwise_scan():
+    city = City(200, 6, headless=True, seed=11)
+
+    for _ in range(5):
+        city.simulation_step()
+
+        for car in city.cars.values():
+            knn_segments = city.topology.knn_segments_of(car.segment, k=CAR_CONTACT_SEGMENT_RANGE)
+            expected = [other_id for other_id, other in city.cars.items()
+                if other_id != car.car_id and other.segment in knn_segments and car.real_distance_to(other) <= CAR_CONTACT_RANGE_AS_ROAD_UNITS]
+
+            assert car.cars_in_contact == expected, car.car_id
+
+def test_same_seed_same_run():
+    a = City(120, 5, headless=True, seed=5)
+    b = City(120, 5, headless=True, seed=5)
+
+    _assert_same_city(a, b)
+
+    for _ in range(20):
+        a.simulation_step()
+        b.simulation_step()
+
+    _assert_same_city(a, b)
+
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_checkpoint_resumes_exactly(tmp_path, vectorized: bool):
+    uninterrupted = City(120, 5, vectorized=vectorized, headless=True, seed=9)
+
+    for _ in range(10):
+        uninterrupted.simulation_step()
+
+    filename = str(tmp_path / "city.npz")
+    uninterrupted.save_checkpoint(filename)
+    resumed = City.from_checkpoint(filename)
+
+    _assert_same_city(uninterrupted, resumed)
+
+    for _ in range(15):
+        uninterrupted.simulation_step()
+        resumed.simulation_step()
+
+    _assert_same_city(uninterrupted, resumed)
+
+def test_decomposed_contacts_match_single_process():
+    single = City(200, 6, headless=True, seed=13)
+    tiled = City(200, 6, headless=True, seed=13)
+    tiled.decompose(3, processes=0)
+
+    try:
+        for _ in range(8):
+            single.simulation_step()
+            tiled.simulation_step()
+
+            _assert_same_city(single, tiled)
+    finally:
+        tiled.close()
@@ -1,34 +1,169 @@
 import random
-#import numpy as np
+import numpy as np
+from collections import OrderedDict
 import networkx as nx
-import matplotlib.pyplot as plt
 
 RANDOM_WEIGHT_MIN = 4
 RANDOM_WEIGHT_MAX = 10
 
+WEIGHTED_DISTANCE_CACHE_SIZE = 1024 # Single source distance tables kept for random weight grids
+
+class GridAdjacency(object):
+    # Sparse (CSR) weighted adjacency of the road grid. Rows keep their
+    # column indices sorted, adj[i][j] gives the weight of (i, j) or 0.
+
+    def __init__(self, num_nodes: int, rows, cols, weights):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        weights = np.asarray(weights)
+
+        order = np.lexsort((cols, rows))
+
+        self.num_nodes = num_nodes
+        self.indices = cols[order]
+        self.weights = weights[order]
+        self.indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(np.bincount(rows, minlength=num_nodes))
+
+        # Plain lists for fast scalar lookups
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._weights = self.weights.tolist()
+
+    def __len__(self):
+        return self.num_nodes
+
+    def __getitem__(self, i: int):
+        return _GridAdjacencyRow(self, i)
+
+    def weight(self, i: int, j: int):
+        for k in range(self._indptr[i], self._indptr[i + 1]):
+            if self._indices[k] == j:
+                return self._weights[k]
+
+        return 0
+
+    def neighbors(self, i: int):
+        return self._indices[self._indptr[i]:self._indptr[i + 1]]
+
+    def edges(self):
+        for i in range(self.num_nodes):
+            for k in range(self._indptr[i], self._indptr[i + 1]):
+                yield (i, self._indices[k], self._weights[k])
+
+    def todense(self):
+        M = [[0 for _ in range(self.num_nodes)] for _ in range(self.num_nodes)]
+
+        for i, j, w in self.edges():
+            M[i][j] = w
+
+        return M
+
+class _GridAdjacencyRow(object):
+    def __init__(self, adj: GridAdjacency, i: int):
+        self._adj = adj
+        self._i = i
+
+    def __len__(self):
+        return self._adj.num_nodes
+
+    def __getitem__(self, j: int):
+        return self._adj.weight(self._i, j)
+
+    def __iter__(self):
+        for j in range(self._adj.num_nodes):
+            yield self._adj.weight(self._i, j)
+
 class SquareGridRoadTopology(object):
     def __init__(self, num_nodes_side: int, random_weights: bool = False, constant_weight=None):
         if constant_weight is None:
             constant_weight = RANDOM_WEIGHT_MAX
 
         self.num_nodes_side = num_nodes_side
+        self.random_weights = random_weights
+        self.constant_weight = constant_weight
         self.adj = self.generate_grid_adj(num_nodes_side, random_weights=random_weights, constant_weight=constant_weight)
-        
-        #self.A = np.matrix(self.adj)
-        #self.G = nx.from_numpy_matrix(self.A)
 
-        self.G = nx.DiGraph()
+        self._G_pos = {num_nodes_side * i + j: (2 * j, 2 * i) for i in range(num_nodes_side) for j in range(num_nodes_side)}
+
+        # networkx graph is only built on first use of G
+        self._G = None
+
+        self._weighted_distance_cache = OrderedDict()
+
+        self._build_segment_tables()
+
+    @property
+    def G(self):
+        if self._G is None:
+            G = nx.DiGraph()
+
+            for node, pos in self._G_pos.items():
+                G.add_node(node, pos=pos)
+
+            G.add_weighted_edges_from(self.adj.edges())
+
+            self._G = G
+
+        return self._G
+
+    def _build_segment_tables(self):
+        # Integer ids for the directed segments, in road_segments order.
+        # Segment ids are positions in the CSR arrays of adj.
+        num_nodes = self.adj.num_nodes
+        indptr = self.adj.indptr
+        out_degree = np.diff(indptr)
+
+        sources = np.repeat(np.arange(num_nodes, dtype=np.int64), out_degree)
+        targets = self.adj.indices
+
+        self.segments = list(zip(sources.tolist(), targets.tolist()))
+        self.segment_nodes = np.stack([sources, targets], axis=1)
+        self.segment_ids = {s: i for i, s in enumerate(self.segments)}
+
+        num_segments = len(self.segments)
+        node_pos = self.node_coords = np.array([self._G_pos[n] for n in range(num_nodes)], dtype=np.float64).reshape(-1, 2)
+
+        self.segment_lens = self.adj.weights.astype(np.float64)
+        self.segment_start_coords = node_pos[sources]
+        self.segment_end_coords = node_pos[targets]
+
+        delta = self.segment_end_coords - self.segment_start_coords
+        self.segment_horizontal = delta[:, 1] == 0
+        self.segment_positive = np.where(self.segment_horizontal, delta[:, 0] > 0, delta[:, 1] > 0)
 
-        for i in range(num_nodes_side):
-            for j in range(num_nodes_side):
-                self.G.add_node(num_nodes_side * i + j, pos=(2 * j, 2 * i))
+        # Reverse direction of every segment and a shared id for both
+        # directions, numbered in unique_road_segments order
+        self.segment_reverse = np.searchsorted(sources * num_nodes + targets, targets * num_nodes + sources)
 
-        for i in range(len(self.adj)):
-            for j in range(len(self.adj)):
-                if self.adj[i][j] > 0:
-                    self.G.add_edge(i, j, weight=self.adj[i][j])
+        first_seen = np.minimum(np.arange(num_segments), self.segment_reverse)
+        undirected_heads = np.flatnonzero(first_seen == np.arange(num_segments))
 
-        self._G_pos = pos = nx.get_node_attributes(self.G,'pos')
+        self.segment_undirected = np.searchsorted(undirected_heads, first_seen)
+        self.undirected_segments = [self.segments[i] for i in undirected_heads.tolist()]
+        self.undirected_segment_nodes = np.stack([sources[undirected_heads], targets[undirected_heads]], axis=1)
+        self.undirected_horizontal = self.segment_horizontal[undirected_heads]
+
+        # Outgoing segments of every joint, in neighbor_segments_to order
+        self._out_segment_ids = [range(lo, hi) for lo, hi in zip(indptr[:-1].tolist(), indptr[1:].tolist())]
+
+        # Same, padded with -1 up to the maximum out degree
+        out_slots = np.arange(max(int(out_degree.max(initial=0)), 1))
+        self.out_segment_table = np.where(out_slots[None, :] < out_degree[:, None], indptr[:-1, None] + out_slots[None, :], -1)
+
+        self._knn_cache = dict()
+        self._knn_array_cache = dict()
+
+        # Segments a car may turn into at the end of a segment (no U-turns),
+        # padded with -1 up to the maximum out degree
+        slots = np.arange(max(int(out_degree.max(initial=0)), 1))
+
+        candidates = indptr[targets][:, None] + slots[None, :]
+        valid = (slots[None, :] < out_degree[targets][:, None]) & (candidates != self.segment_reverse[:, None])
+        compacted = np.argsort(~valid, axis=1, kind="stable")
+
+        self.next_segment_counts = valid.sum(axis=1).astype(np.int64)
+        self.next_segment_table = np.take_along_axis(np.where(valid, candidates, -1), compacted, axis=1)[:, :max(int(self.next_segment_counts.max(initial=0)), 1)]
 
     @property
     def joints(self):
@@ -36,20 +171,14 @@ class SquareGridRoadTopology(object):
 
     @property
     def road_segments(self):
-        return list(nx.get_edge_attributes(self.G, 'weight').keys())
+        return list(self.segments)
 
     @property
     def unique_road_segments(self):
-        sss = list()
-
-        for s in self.road_segments:
-            if s not in sss and (s[1], s[0]) not in sss:
-                sss.append(s)
-
-        return sss
+        return list(self.undirected_segments)
 
     def neighbor_segments_to(self, segment: tuple):
-        return [elem for elem in self.road_segments if elem[0] == segment[1]]
+        return [self.segments[i] for i in self._out_segment_ids[segment[1]]]
 
     def is_segment_vertical(self, segment: tuple):
         return (self._G_pos[segment[1]][0] - self._G_pos[segment[0]][0]) == 0
@@ -64,53 +193,124 @@ class SquareGridRoadTopology(object):
         return (self._G_pos[segment[1]][1] - self._G_pos[segment[0]][1]) > 0
 
     def knn_segments_of(self, segment: tuple, k: int = 1):
-        segs = set(self.knn_directed_segments_of(segment, k=k) + self.knn_directed_segments_of((segment[1], segment[0]), k=k))
-        additionals = set()
+        return [self.segments[i] for i in self.knn_segment_ids_of(self.segment_ids[segment], k=k)]
+
+    def knn_segment_ids_of(self, segment_id: int, k: int = 1):
+        # Both directions of every segment within k same-orientation hops of
+        # either direction of segment_id. Cached per (segment, k).
+        key = (segment_id, k)
+        segs = self._knn_cache.get(key)
+
+        if segs is None:
+            directed = self.knn_directed_segment_ids_of(segment_id, k=k) | self.knn_directed_segment_ids_of(self.segment_reverse[segment_id], k=k)
+            segs = frozenset(directed | set(self.segment_reverse[list(directed)].tolist()))
+
+            self._knn_cache[key] = segs
+
+        return segs
+
+    def in_knn_segments(self, segment_ids, other_segment_ids, k: int = 1):
+        # Vectorized `other in knn_segment_ids_of(segment, k)` over pairs of
+        # segment ids, joined on (segment, neighbour) keys
+        segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        other_segment_ids = np.asarray(other_segment_ids, dtype=np.int64)
+
+        if len(segment_ids) == 0:
+            return np.zeros(0, dtype=bool)
+
+        num_segments = len(self.segments)
+        allowed = list()
+
+        for segment_id in np.unique(segment_ids).tolist():
+            key = (segment_id, k)
+            nbs = self._knn_array_cache.get(key)
+
+            if nbs is None:
+                nbs = self._knn_array_cache[key] = np.sort(np.fromiter(self.knn_segment_ids_of(segment_id, k=k), dtype=np.int64))
 
-        for s in segs:
-            if (s[1], s[0]) not in segs:
-                additionals.add((s[1], s[0]))
+            allowed.append(segment_id * num_segments + nbs)
 
-        return list(segs.union(additionals))
+        allowed = np.concatenate(allowed)
+
+        if len(allowed) == 0:
+            return np.zeros(len(segment_ids), dtype=bool)
+
+        keys = segment_ids * num_segments + other_segment_ids
+        pos = np.minimum(np.searchsorted(allowed, keys), len(allowed) - 1)
+
+        return allowed[pos] == keys
 
     def knn_directed_segments_of(self, segment: tuple, k: int = 1):
+        return [self.segments[i] for i in self.knn_directed_segment_ids_of(self.segment_ids[segment], k=k)]
+
+    def knn_directed_segment_ids_of(self, segment_id: int, k: int = 1):
+        # Segments reachable from segment_id in at most k hops without
+        # leaving its orientation, walked level by level over the
+        # precomputed outgoing adjacency
+        horizontal = self.segment_horizontal[segment_id]
         nbs = set()
+        frontier = [segment_id]
 
-        if self.is_segment_horizontal(segment):
-            vh_func = self.is_segment_horizontal
-        else:
-            vh_func = self.is_segment_vertical
+        for _ in range(k):
+            new_nbs = set()
 
-        #if self.is_segment_positive(segment):
-        #    pn_func = self.is_segment_positive
-        #else:
-        #    pn_func = lambda s: not self.is_segment_positive(s)
+            for s in frontier:
+                for n in self._out_segment_ids[self.segments[s][1]]:
+                    if self.segment_horizontal[n] == horizontal and n not in nbs:
+                        new_nbs.add(n)
 
-        for _ in range(k):
-            if len(nbs) == 0:
-                new_nbs = [s for s in self.neighbor_segments_to(segment) if vh_func(s)]# and pn_func(s) and s != segment]
+            if len(new_nbs) == 0:
+                break
+
+            nbs |= new_nbs
+            frontier = new_nbs
+
+        return nbs
 
-                if len(new_nbs) == 0:
-                    break
+    def distance(self, source: int, target: int, weighted: bool = False):
+        # Shortest path length between two joints. Hop counts on the full
+        # grid are the Manhattan distance; weighted lengths are the same
+        # scaled by the weight on constant weight grids, otherwise served
+        # from LRU cached single source Dijkstra tables.
+        source_row, source_col = divmod(source, self.num_nodes_side)
+        target_row, target_col = divmod(target, self.num_nodes_side)
+        hops = abs(source_row - target_row) + abs(source_col - target_col)
 
-                for s in new_nbs:
-                    nbs.add(s)
-            else:
-                # NOTE: this is too unefficient
-                new_nbs = list()
+        if not weighted:
+            return hops
 
-                for s_ in nbs:
-                    new_nbs += [s for s in self.neighbor_segments_to(s_) if vh_func(s)]# and pn_func(s) and s != segment]
+        if not self.random_weights:
+            return hops * self.constant_weight
 
-                if len(new_nbs) == 0:
-                    break
+        return self._weighted_distances_from(source)[target]
 
-                for s in new_nbs:
-                    nbs.add(s)
+    def hop_distances(self, sources, targets):
+        # Vectorized distance(source, target) in hops
+        source_row, source_col = np.divmod(np.asarray(sources), self.num_nodes_side)
+        target_row, target_col = np.divmod(np.asarray(targets), self.num_nodes_side)
 
-        return list(nbs)
+        return np.abs(source_row - target_row) + np.abs(source_col - target_col)
+
+    def _weighted_distances_from(self, source: int):
+        distances = self._weighted_distance_cache.get(source)
+
+        if distances is not None:
+            self._weighted_distance_cache.move_to_end(source)
+            return distances
+
+        lengths = nx.single_source_dijkstra_path_length(self.G, source)
+        distances = [lengths[n] for n in range(self.adj.num_nodes)]
+
+        self._weighted_distance_cache[source] = distances
+
+        if len(self._weighted_distance_cache) > WEIGHTED_DISTANCE_CACHE_SIZE:
+            self._weighted_distance_cache.popitem(last=False)
+
+        return distances
 
     def plot(self):
+        import matplotlib.pyplot as plt
+
         #pos = nx.get_node_attributes(self.G,'pos')
         nx.draw(self.G, self._G_pos, with_labels=True, connectionstyle='arc3, rad = 0.1', node_size=1000, font_size=20)
         labels = nx.get_edge_attributes(self.G, 'weight')
@@ -128,7 +328,7 @@ class SquareGridRoadTopology(object):
             weight_generator = lambda:  random.randint(RANDOM_WEIGHT_MIN, RANDOM_WEIGHT_MAX)
 
         n = num_nodes_side**2
-        M = [[0 for _ in range(n)] for _ in range(n)]
+        rows, cols, weights = [], [], []
 
         for r in range(num_nodes_side):
             for c in range(num_nodes_side):
@@ -136,12 +336,14 @@ class SquareGridRoadTopology(object):
                 # Two inner diagonals
                 if c > 0:
                     _w = weight_generator()
-                    M[i-1][i] = _w
-                    M[i][i-1] = _w
+                    rows += [i-1, i]
+                    cols += [i, i-1]
+                    weights += [_w, _w]
                 # Two outer diagonals
                 if r > 0:
                     _w = weight_generator()
-                    M[i-num_nodes_side][i] = _w
-                    M[i][i-num_nodes_side] = _w
-        
-        return M
\ No newline at end of file
+                    rows += [i-num_nodes_side, i]
+                    cols += [i, i-num_nodes_side]
+                    weights += [_w, _w]
+
+        return GridAdjacency(n, rows, cols, weights)